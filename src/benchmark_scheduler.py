@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+
+import sys
+import time
+import random
+import bgp_sim
+
+#
+# Hold model benchmark: the queue is filled with queue_size events, then each
+# step pops the earliest event and schedules a new one a link delay later,
+# like EVENT_RECEIVE chains do during a convergence.
+#
+def hold_benchmark(kind, queue_size, steps, seed="benchmark"):
+	rand_seed = random.Random(seed)
+	bgp_sim.init()
+	bgp_sim._seq_seed = 0
+	bgp_sim.setEventScheduler(kind)
+	scheduler = bgp_sim._event_Scheduler
+
+	for i in xrange(queue_size):
+		scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(rand_seed.uniform(0, 1)), [i], bgp_sim.EVENT_RECEIVE))
+
+	order = []
+	start = time.time()
+	for i in xrange(steps):
+		event = scheduler.pop(0)
+		order.append(event.seq)
+		delay = bgp_sim.interpretDelayfunc(None, rand_seed, bgp_sim.default_link_delay_func)
+		scheduler.add(bgp_sim.CEvent(event.time + bgp_sim.toSystemTime(delay), event.param, bgp_sim.EVENT_RECEIVE))
+	elapsed = time.time() - start
+
+	return (steps/elapsed, order)
+
+if __name__ == "__main__":
+	steps = 20000
+	if len(sys.argv) > 1:
+		steps = int(sys.argv[1])
+
+	print "%10s %15s %15s %15s %10s" % ("queue", "list (ev/s)", "heap (ev/s)", "calendar (ev/s)", "same order")
+	for queue_size in [1000, 10000, 100000]:
+		(list_rate, list_order) = hold_benchmark(bgp_sim.SCHEDULER_LIST, queue_size, steps)
+		(heap_rate, heap_order) = hold_benchmark(bgp_sim.SCHEDULER_HEAP, queue_size, steps)
+		(calendar_rate, calendar_order) = hold_benchmark(bgp_sim.SCHEDULER_CALENDAR, queue_size, steps)
+		print "%10d %15.0f %15.0f %15.0f %10s" % (queue_size, list_rate, heap_rate, calendar_rate, list_order == heap_order == calendar_order)
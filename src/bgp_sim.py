@@ -8,8 +8,21 @@ import random
 import radix
 import networkx
 import bz2
-
-from collections import defaultdict
+import heapq
+import weakref
+import bisect
+import math
+import multiprocessing
+import cPickle
+import gzip
+import os
+import select
+import traceback
+import json
+import struct
+import mmap
+
+from collections import defaultdict, OrderedDict
 from utils import *
 from lib.aggregates import wrapper
 
@@ -52,6 +65,32 @@ SHOW_EXPORT_FILTER_EVENTS = False
 
 CHECK_LOOP = False
 
+# Merge an EVENT_UPDATE into the one already pending for the same router and prefix
+COALESCE_UPDATES = False
+
+# Drop an in-flight UPDATE when a newer one is sent on the same link for the same prefix
+SUPERSEDE_IN_FLIGHT = False
+
+# Run the decision process once per router for all the prefixes received in a processing window
+BATCH_DECISIONS = False
+
+# Cancel the scheduled events made obsolete by DRAGON filtering, MRAI resets and link failures
+CANCEL_OBSOLETE_EVENTS = False
+
+# Keep the MRAI timers of each router in a hierarchical timer wheel, with at most one pending
+# expiry per peer (and prefix if prefix-based), and only schedule the wheel's next deadline
+MRAI_TIMER_WHEEL = False
+
+# Record the convergence time of injected events, and stop the run once the
+# control plane is quiescent and only MRAI timers and terminate events are left
+QUIESCENCE_DETECTION = False
+
+# Write the performance counters (see perfReport) as JSON to this file at the end of the run
+PERF_REPORT = None
+
+# Record the processed events in this binary trace file (see replayTrace)
+EVENT_TRACE = None
+
 _link_delay_table = {}
 default_link_delay_func = ["uniform", 0.01, 0.1]
 default_process_delay_func = ["uniform", 0.001, 0.01]
@@ -102,6 +141,28 @@ EVENT_OUTPUT_UPDATES = 11
 EVENT_ACTIVATE_DEBUG = 12
 EVENT_START_TRACK_TIME = 13
 EVENT_STOP_TRACK_TIME = 14
+EVENT_BATCH_UPDATE = 15
+EVENT_MRAI_WHEEL = 16
+
+_event_names = {
+	EVENT_TERMINATE: "TERMINATE",
+	EVENT_MRAI_EXPIRE_SENDTO: "MRAI_EXPIRE_SENDTO",
+	EVENT_UPDATE: "UPDATE",
+	EVENT_RECEIVE: "RECEIVE",
+	EVENT_LINK_DOWN: "LINK_DOWN",
+	EVENT_LINK_UP: "LINK_UP",
+	EVENT_ANNOUNCE_PREFIX: "ANNOUNCE_PREFIX",
+	EVENT_WITHDRAW_PREFIX: "WITHDRAW_PREFIX",
+	EVENT_SHOW_ALL_RIBS: "SHOW_ALL_RIBS",
+	EVENT_RESET_COUNTERS: "RESET_COUNTERS",
+	EVENT_ACTIVATE_DEAGGREGATES: "ACTIVATE_DEAGGREGATES",
+	EVENT_OUTPUT_UPDATES: "OUTPUT_UPDATES",
+	EVENT_ACTIVATE_DEBUG: "ACTIVATE_DEBUG",
+	EVENT_START_TRACK_TIME: "START_TRACK_TIME",
+	EVENT_STOP_TRACK_TIME: "STOP_TRACK_TIME",
+	EVENT_BATCH_UPDATE: "BATCH_UPDATE",
+	EVENT_MRAI_WHEEL: "MRAI_WHEEL",
+}
 
 IBGP_SESSION = 0
 EBGP_SESSION = 1
@@ -109,7 +170,36 @@ EBGP_SESSION = 1
 LINK_DOWN = -1
 LINK_UP   = 0
 
+SCHEDULER_LIST = 0 # COrderedList, reference implementation
+SCHEDULER_HEAP = 1 # CEventHeap
+SCHEDULER_CALENDAR = 2 # CCalendarQueue
+
+EVENT_SCHEDULER = SCHEDULER_HEAP
+CALENDAR_WIDTH = None # bucket width of the calendar queue (system time), None to auto-tune
+
 _seq_seed = 0
+_cancelled_events = 0
+_pending_events = None # key: event type, value: number of scheduled events
+
+_message_events = frozenset([EVENT_RECEIVE, EVENT_UPDATE, EVENT_BATCH_UPDATE])
+_injected_events = frozenset([EVENT_ANNOUNCE_PREFIX, EVENT_WITHDRAW_PREFIX, EVENT_LINK_DOWN, EVENT_LINK_UP])
+# Events reading the state of all the routers. Parallel and sharded runs process
+# them in the coordinator, with the merged router states.
+_output_events = frozenset([EVENT_SHOW_ALL_RIBS, EVENT_OUTPUT_UPDATES, EVENT_STOP_TRACK_TIME])
+_quiescent = True
+_busy_peer = None # last peer found with an out_queue not empty
+_unconverged_events = None # injected events processed since the last quiescence
+_convergence_log = None # (event type, param, injection time, convergence time)
+
+_perf_count = None # key: event type, value: number of processed events
+_perf_time = None # key: event type, value: wall-clock time (in seconds) spent processing them
+_perf_peak = None # key: event type, value: peak number of scheduled events
+_perf_start = None # wall-clock time of init
+
+start_time = 0 # time (in seconds) of the last EVENT_START_TRACK_TIME
+cur_time = 0 # time (in seconds) of the last processed event, except the track time events
+
+_trace_writer = None # CTraceWriter of the processed events
 
 ######################
 ## Utility functions #
@@ -164,6 +254,28 @@ def interpretDelayfunc(obj, rand_seed, delayfunc):
 			print "Unsupported distribution", self.delayfunc
 			sys.exit(-1)
 
+#
+# Return the mean value (in seconds) of a delay function
+#
+def delayfuncMean(delayfunc):
+	if delayfunc[0] == "deterministic":
+		return delayfunc[1]
+	elif delayfunc[0] == "normal": # normal mu sigma
+		return delayfunc[1]
+	elif delayfunc[0] == "uniform": # uniform a b
+		return (delayfunc[1] + delayfunc[2])/2.0
+	elif delayfunc[0] == "exponential": # exponential lambda
+		return 1.0/delayfunc[1]
+	elif delayfunc[0] == "pareto": # pareto alpha
+		if delayfunc[1] > 1:
+			return delayfunc[1]/(delayfunc[1] - 1.0)
+		return 1.0
+	elif delayfunc[0] == "weibull": # weibull alpha beta
+		return delayfunc[1]*math.gamma(1 + 1.0/delayfunc[2])
+	else:
+		print "Unsupported distribution", delayfunc
+		sys.exit(-1)
+
 def toSystemTime(tm):
 	return tm*1000000
 
@@ -194,6 +306,15 @@ class CRouter:
 	rand_seed = None
 	announced_prefixes = None
 	is_stub = False
+	pending_updates = None # prefixes with a pending EVENT_UPDATE
+	batch_prefixes = None # prefixes waiting for the pending EVENT_BATCH_UPDATE, ordered set (OrderedDict with None values)
+	batching = False
+	batch_send = None # prefixes to send at the end of the batch, ordered set (OrderedDict with None values)
+	batch_aggregates = False
+	mrai_events = None # key: (pid, prefix or None), pending EVENT_MRAI_EXPIRE_SENDTO
+	mrai_wheel = None # CTimerWheel of the MRAI expiries, with MRAI_TIMER_WHEEL
+	mrai_wheel_event = None # pending EVENT_MRAI_WHEEL, at the next deadline of mrai_wheel
+	adj_rib_in = None # CAdjRibIn, indexed by prefix
 	
 	### Experiments
 	
@@ -201,6 +322,20 @@ class CRouter:
 	## key is the peer_id of the neighor I'm sending updates to
 	## value is the total number of updates
 	num_updates = None
+	
+	## Number of decision runs saved by coalescing EVENT_UPDATEs
+	num_coalesced_updates = 0
+	
+	### Performance counters
+	
+	## Number of decision runs (calls to update)
+	num_decision_runs = 0
+	## Number of calls to compute_local_aggregates
+	num_aggregates_computations = 0
+	## Wall-clock time (in seconds) spent in the aggregates library
+	aggregation_time = 0.0
+	## Number of paths built for the update groups (calls to exportAction)
+	num_exports = 0
 
 	def __init__(self, a, i):
 		global MRAI_PEER_BASED, RANDOMIZED_KEY
@@ -220,10 +355,46 @@ class CRouter:
 		self.rand_seed = random.Random(seed)
 		self.announced_prefixes  = set()
 		self.num_updates = defaultdict(int)
+		self.pending_updates = set()
+		self.num_coalesced_updates = 0
+		self.num_decision_runs = 0
+		self.num_aggregates_computations = 0
+		self.aggregation_time = 0.0
+		self.num_exports = 0
+		self.batch_prefixes = OrderedDict()
+		self.batching = False
+		self.batch_send = OrderedDict()
+		self.batch_aggregates = False
+		self.mrai_events = {}
+		self.mrai_wheel = CTimerWheel()
+		self.mrai_wheel_event = None
+		self.adj_rib_in = CAdjRibIn(self.peers)
 
 	def __str__(self):
 		return str(self.id) + "(" + str(self.asn) + ")"
 
+	#
+	# Pickling support: the radix tree and the aggregate tree are rebuilt
+	# from their prefixes
+	#
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state['loc_rib'] = [(node.prefix, node.data) for node in self.loc_rib.nodes()]
+		state['aggregate_tree'] = wrapper.get_tree_pfxes(self.aggregate_tree)
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.loc_rib = radix.Radix()
+		for (prefix, data) in state['loc_rib']:
+			node = self.loc_rib.add(prefix)
+			node.data.update(data)
+		self.aggregate_tree = wrapper.aggregate_tree()
+		for (prefix, route_type) in state['aggregate_tree']:
+			wrapper.insert_pfx(self.aggregate_tree, prefix, route_type)
+		# The order of the peers may have changed
+		self.adj_rib_in.rebuild()
+
 	def setMRAI(self, pid, prefix):
 		return self.setMRAIvalue(pid, prefix, self.peers[pid].mrai_timer())
 
@@ -240,10 +411,10 @@ class CRouter:
 		else: # MRAI_PREFIX_BASED:
 			if not self.mrai.has_key(pid):
 				self.mrai[pid] = {}
-			if (not self.mrai[pid].has_key(perfix)) or self.mrai[pid][prefix] < _systime: # if mrai has not been set yet
+			if (not self.mrai[pid].has_key(prefix)) or self.mrai[pid][prefix] < _systime: # if mrai has not been set yet
 				self.mrai[pid][prefix] = _systime + value
 				if SHOW_DEBUG:
-					print str(self), "set MRAI timer for ", pid, prefix, "to", self.mrai[pid]
+					print str(self), "set MRAI timer for ", pid, prefix, "to", self.mrai[pid][prefix]
 			return self.mrai[pid][prefix]
 			
     #
@@ -251,13 +422,14 @@ class CRouter:
     #
 	def resetMRAI(self, pid, prefix):
 		global MRAI_PEER_BASED, MRAI_PREFIX_BASED
-		if self.mrai_setting == MRAI_PEER_BASED and self.mrai.has_key(pid):
-			self.mrai[pid] = 0
+		if self.mrai_setting == MRAI_PEER_BASED:
+			if self.mrai.has_key(pid):
+				self.mrai[pid] = 0
 				#print str(self), "set mrai timer for ", pid, "to", self.mrai[pid]
 		else: # MRAI_PREFIX_BASED:
-			if self.mrai.has_key(pid) and self.mrai[pid].has_key(perfix): # if mrai has not been set yet
+			if self.mrai.has_key(pid) and self.mrai[pid].has_key(prefix): # if mrai has not been set yet
 				self.mrai[pid][prefix] = 0
-				#print str(self), "set mrai timer for ", pid, prefix, "to", self.mrai[pid]
+				#print str(self), "set mrai timer for ", pid, prefix, "to", self.mrai[pid][prefix]
     #
     # Return next expiring time, or -1 if timer expired.
     #
@@ -268,7 +440,7 @@ class CRouter:
 				return -1 # expires
 			else:
 				return self.mrai[pid] # return the expected expiring time
-		elif self.mrai_setting ==  MRAI_PERFIX_BASED:
+		elif self.mrai_setting == MRAI_PREFIX_BASED:
 			if (not self.mrai.has_key(pid)) or (not self.mrai[pid].has_key(prefix)) or self.mrai[pid][prefix] < _systime:
 				return -1 #expired
 			else:
@@ -276,6 +448,87 @@ class CRouter:
 		else:
 			print "Invalid MRAI setting"
 			sys.exit(-1)
+
+    #
+    # Schedule the MRAI expiry for peer pid (and prefix if prefix-based). The expiry
+    # it replaces is cancelled when obsolete events are cancelled.
+    #
+	def scheduleMRAIExpiry(self, pid, prefix, next_mrai):
+		if MRAI_TIMER_WHEEL:
+			self.mrai_wheel.schedule((pid, prefix), next_mrai)
+			event = self.mrai_wheel_event
+			if event is None or event.cancelled or event.time > next_mrai:
+				self.scheduleMRAIWheel()
+			return
+		if CANCEL_OBSOLETE_EVENTS:
+			event = self.mrai_events.get((pid, prefix))
+			if event is not None and not event.cancelled:
+				if event.time == next_mrai:
+					return
+				event.cancel()
+		event = CEvent(next_mrai, (self.id, pid, prefix), EVENT_MRAI_EXPIRE_SENDTO)
+		self.mrai_events[(pid, prefix)] = event
+		_event_Scheduler.add(event)
+
+    #
+    # Make sure that an MRAI expiry is pending while the timer runs
+    #
+	def ensureMRAIExpiry(self, pid, prefix, next_mrai):
+		if MRAI_TIMER_WHEEL:
+			if (pid, prefix) not in self.mrai_wheel:
+				self.scheduleMRAIExpiry(pid, prefix, next_mrai)
+		elif CANCEL_OBSOLETE_EVENTS:
+			event = self.mrai_events.get((pid, prefix))
+			if event is None or event.cancelled:
+				self.scheduleMRAIExpiry(pid, prefix, next_mrai)
+
+    #
+    # Cancel the pending MRAI expiry for peer pid (and prefix if prefix-based)
+    #
+	def cancelMRAIExpiry(self, pid, prefix):
+		if MRAI_TIMER_WHEEL:
+			# The wheel event is kept, it schedules the next deadline when processed
+			self.mrai_wheel.cancel((pid, prefix))
+			return
+		event = self.mrai_events.pop((pid, prefix), None)
+		if event is not None:
+			event.cancel()
+
+    #
+    # Return the (pid, prefix or None) of the pending MRAI expiries
+    #
+	def pendingMRAIExpiries(self):
+		if MRAI_TIMER_WHEEL:
+			return self.mrai_wheel.keys()
+		return self.mrai_events.keys()
+
+    #
+    # Make sure that EVENT_MRAI_WHEEL is scheduled at the next deadline of the
+    # wheel. A later one is cancelled, an earlier one is processed and schedules
+    # the next deadline.
+    #
+	def scheduleMRAIWheel(self):
+		next_mrai = self.mrai_wheel.nextDeadline()
+		if next_mrai is None:
+			return
+		event = self.mrai_wheel_event
+		if event is not None and not event.cancelled:
+			if event.time <= next_mrai:
+				return
+			event.cancel()
+		self.mrai_wheel_event = CEvent(next_mrai, (self.id,), EVENT_MRAI_WHEEL)
+		_event_Scheduler.add(self.mrai_wheel_event)
+
+    #
+    # Process the MRAI expiries of the wheel that are due
+    #
+	def expireMRAIWheel(self, event):
+		if self.mrai_wheel_event is event:
+			self.mrai_wheel_event = None
+		for (pid, prefix) in self.mrai_wheel.expire(_systime):
+			self.resetMRAI(pid, prefix)
+			self.sendto(pid, prefix)
+		self.scheduleMRAIWheel()
     #
     # Return the link corresponding to the peer pid
     #
@@ -294,8 +547,8 @@ class CRouter:
 				return False
 		maps = self.peers[pid].getRouteMapIn()
 		for mapname in maps:
-			map = _route_map_list[mapname]
-			if len(map.action) == 0 and (((not map.permit) and map.isMatch(prefix, path)) or (map.permit and (not map.isMatch(prefix, path)))):
+			rejects = _route_map_list[mapname].rejects
+			if rejects is not None and rejects(prefix, path):
 				return False
 		return True
 
@@ -311,24 +564,31 @@ class CRouter:
 			newpath.nexthop = self.peers[pid].id
 			newpath.local_pref = default_local_preference
 			newpath.igp_cost = 0
-			if len(newpath.aspath) == 0 or newpath.aspath[0] != _router_list[pid].asn:
-				newpath.aspath = (_router_list[pid].asn,) + newpath.aspath
+			if newpath.aspath.asn != _router_list[pid].asn:
+				newpath.aspath = newpath.aspath.prepend(_router_list[pid].asn)
 		else:
 			newpath.igp_cost = self.getPeerLink(pid).cost + newpath.igp_cost
 			newpath.weight = default_weight
 		newpath.src_pid = pid
 		maps = self.peers[pid].getRouteMapIn()
 		for mapname in maps:
-			map = _route_map_list[mapname]
-			if map.permit and len(map.action) > 0 and map.isMatch(prefix, newpath):
-				newpath = map.performAction(newpath)
-		return newpath
+			apply = _route_map_list[mapname].apply
+			if apply is not None:
+				newpath = apply(prefix, newpath)
+		return internPath(newpath)
 
     #
     # Check if a path can be exported to a peer: Loop detection & map filtering 
     #
 	def exportFilter(self, pid, prefix, path):
-		global _router_list, ssld, _route_map_list, SHOW_DEBUG
+		return self.exportLoopFilter(pid, path) and self.exportRouteMapFilter(pid, prefix, path)
+
+    #
+    # Check the path against the loop detection and route reflection rules for
+    # peer pid
+    #
+	def exportLoopFilter(self, pid, path):
+		global _router_list, ssld
 		if path.src_pid == pid:
 			if SHOW_EXPORT_FILTER_EVENTS:
 				print "source loop detection fail!"
@@ -352,12 +612,17 @@ class CRouter:
 					if SHOW_EXPORT_FILTER_EVENTS:
 						print "IBGPXXXXX:", str(self), path.src_pid, self.peers[path.src_pid].route_reflector_client, pid, self.peers[pid].route_reflector_client, "ibgp route-refelctor checking fail!"
 					return False
+		return True
 
-		#Route maps application
+    #
+    # Check if a path passes the outbound route maps of peer pid, which are the
+    # same for all the peers of its update group
+    #
+	def exportRouteMapFilter(self, pid, prefix, path):
 		maps = self.peers[pid].getRouteMapOut()
 		for mapname in maps:
-			map = _route_map_list[mapname]
-			if len(map.action) == 0 and (((not map.permit) and map.isMatch(prefix, path)) or (map.permit and (not map.isMatch(prefix, path)))):
+			rejects = _route_map_list[mapname].rejects
+			if rejects is not None and rejects(prefix, path):
 				if SHOW_EXPORT_FILTER_EVENTS:
 					print "route map fail!"
 				return False
@@ -372,14 +637,15 @@ class CRouter:
 		newpath.copy(path)
 		if self.peers[pid].link.ibgp_ebgp() == EBGP_SESSION:
 			newpath.local_pref = -1
-			newpath.aspath = (self.asn,) + newpath.aspath # append paths
+			newpath.aspath = newpath.aspath.prepend(self.asn) # append paths
 			newpath.igp_cost = -1
 		maps = self.peers[pid].getRouteMapOut()
 		for mapname in maps:
-			map = _route_map_list[mapname]
-			if map.permit and len(map.action) > 0 and map.isMatch(prefix, newpath):
-				path = map.performAction(newpath)
-		return newpath
+			apply = _route_map_list[mapname].apply
+			if apply is not None:
+				newpath = apply(prefix, newpath)
+		self.num_exports += 1
+		return internPath(newpath)
 
     #
     # Compare two paths
@@ -387,6 +653,27 @@ class CRouter:
 	def comparePath(self, path1, path2):
 		return path1.compareTo(path2)
 	
+	#
+	# Sort paths by preference, on their ranking keys unless paths from the same
+	# neighbor AS have different MEDs (compareTo is then not an order)
+	#
+	def sortPaths(self, paths):
+		if not bgp_always_compare_med:
+			meds = {}
+			for path in paths:
+				if path.aspath and meds.setdefault(path.aspath[0], path.med) != path.med:
+					paths.sort(self.comparePath)
+					return
+		paths.sort(key=CPath.rankKey)
+	
+	#
+	# Forwarding neighbors of a route type: the peers of the paths of that type
+	#
+	def fwdNeighbors(self, inpaths, selection, route_type):
+		if selection is not None:
+			return selection.neighbors(route_type)
+		return set([path.src_pid for path in inpaths if path.route_type == route_type])
+	
 	def get_customers(self):
 		return [peer for peer in self.peers if self.peers[peer].peer_type == CUSTOMER]
 	
@@ -475,13 +762,18 @@ class CRouter:
 						print "%s %s DRAGON. Dequeuing potential enqueued UPDATEs for prefix %s to peer %s" %\
 							 (getSystemTimeStr(), self.id, prefix, peer.id)
 					peer.dequeue(prefix)
-					_event_Scheduler.add(CEvent(self.getPeerLink(peer.id).next_delivery_time(self.id, withdraw_update.size()),\
-						 [self.id, peer.id, withdraw_update], EVENT_RECEIVE))
+					self.transmit(peer.id, withdraw_update)
 				else:
 					if DRAGON_DEBUG:
 						print "%s %s DRAGON. I filter prefix %s but don't send a WITHDRAW to %s. But I dequeue, just in case..." %\
 							 (getSystemTimeStr(), self.id, prefix, peer.id)
 					peer.dequeue(prefix)
+				if CANCEL_OBSOLETE_EVENTS:
+					# Nothing left to send when the MRAI expires
+					if self.mrai_setting != MRAI_PEER_BASED:
+						self.cancelMRAIExpiry(peer.id, prefix)
+					elif not peer.out_queue:
+						self.cancelMRAIExpiry(peer.id, None)
 		else:
 			if DRAGON_DEBUG:
 				print "%s %s DRAGON. Asked to filter prefix %s which is already filtered." %\
@@ -512,27 +804,33 @@ class CRouter:
 		###  via a customer. But now I've lost it because of a WITHDRAW. 
 		###  I need to re-advertise the aggregate.
 		
+		# Only the best received path is needed, unless an aggregate competes with them
+		selection = self.adj_rib_in.selections.get(prefix)
 		if DRAGON_ACTIVATED:
 		    # prefix not in self.aggregated_prefixes
 		    if self.origin_rib.has_key(prefix) and (prefix not in self.aggregated_prefixes):
 		    	inpaths.append(self.origin_rib[prefix])
-		    else:
-		    	if prefix in self.aggregated_prefixes:
-		    		inpaths.append(self.origin_rib[prefix])
-		    	for peer in self.peers.values():
-		    		if peer.rib_in.has_key(prefix):
-		    			for path in peer.rib_in[prefix]:
-		    				inpaths.append(path)
-		    	inpaths.sort(self.comparePath)
+		    	selection = None
+		    elif prefix in self.aggregated_prefixes:
+		    	inpaths.append(self.origin_rib[prefix])
+		    	if selection is not None:
+		    		inpaths.extend(selection.orderedPaths())
+		    	self.sortPaths(inpaths)
+		    	selection = None
+		    elif selection is not None:
+		    	inpaths = selection.selectedPaths()
+		    	if len(inpaths) > 1:
+		    		self.sortPaths(inpaths)
+		    		selection = None
 		else:
 		    if self.origin_rib.has_key(prefix):
 		    	inpaths.append(self.origin_rib[prefix])
-		    else:
-		    	for peer in self.peers.values():
-		    		if peer.rib_in.has_key(prefix):
-		    			for path in peer.rib_in[prefix]:
-		    				inpaths.append(path)
-		    	inpaths.sort(self.comparePath)
+		    	selection = None
+		    elif selection is not None:
+		    	inpaths = selection.selectedPaths()
+		    	if len(inpaths) > 1:
+		    		self.sortPaths(inpaths)
+		    		selection = None
 		
 		if DRAGON_DEBUG:
 			print "%s %s Running Decision Process for prefix %s with inpaths: %s" %\
@@ -551,9 +849,8 @@ class CRouter:
 				return [change, trend, node, replace_local_aggregate]
 		
 		if not node.data['best_path'] and inpaths:
-			node.data['type'] = int(inpaths[0].community[0])
-			node.data['fwd_neighbors'] = set([path.src_pid for path in inpaths if\
-				 int(path.community[0]) == node.data['type']])
+			node.data['type'] = inpaths[0].route_type
+			node.data['fwd_neighbors'] = self.fwdNeighbors(inpaths, selection, node.data['type'])
 			node.data['best_path'] = inpaths[0]
 			trend = 1
 			change = True
@@ -567,11 +864,10 @@ class CRouter:
 			if prefix in self.aggregated_prefixes and DRAGON_ACTIVATED:
 				## I'm advertising an aggregate, but now I've received a route via a customer. So, I can stop advertising the former.
 				if len(inpaths) > 1:
-					if int(inpaths[1].community[0]) == 1:
+					if inpaths[1].route_type == 1:
 						node.data['type'] = 1
 						node.data['best_path'] = inpaths[1]
-						node.data['fwd_neighbors'] = set([path.src_pid for path in inpaths if\
-							int(path.community[0]) == node.data['type']])
+						node.data['fwd_neighbors'] = self.fwdNeighbors(inpaths, selection, node.data['type'])
 						change = True
 						trend = 1
 						replace_local_aggregate = True
@@ -586,28 +882,25 @@ class CRouter:
 						## advertising my route, or it turns out that I was not
 						## the first to advertise the route ... in which case
 						## I've to start advertising it here!
-						node.data['type'] = int(inpaths[0].community[0])
-						node.data['fwd_neighbors'] = set([path.src_pid for path in inpaths if\
-							 int(path.community[0]) == node.data['type']])
+						node.data['type'] = inpaths[0].route_type
+						node.data['fwd_neighbors'] = self.fwdNeighbors(inpaths, selection, node.data['type'])
 						node.data['best_path'] = inpaths[0]
 						trend = 1
 						change = True
 				else:
 					## There is only one path in inpaths...
-					node.data['type'] = int(inpaths[0].community[0])
-					node.data['fwd_neighbors'] = set([path.src_pid for path in inpaths if\
-						 int(path.community[0]) == node.data['type']])
+					node.data['type'] = inpaths[0].route_type
+					node.data['fwd_neighbors'] = self.fwdNeighbors(inpaths, selection, node.data['type'])
 					node.data['best_path'] = inpaths[0]
 					trend = 1
 					change = True
 			else:		
 				trend = node.data['best_path'].compareTo(inpaths[0])
 				old_best_path = node.data['best_path']
-				node.data['type'] = int(inpaths[0].community[0])
+				node.data['type'] = inpaths[0].route_type
 				node.data['best_path'] = inpaths[0]
-				node.data['fwd_neighbors'] = set([path.src_pid for path in inpaths if\
-					int(path.community[0]) == node.data['type']])
-				change = (old_best_path != node.data['best_path'])
+				node.data['fwd_neighbors'] = self.fwdNeighbors(inpaths, selection, node.data['type'])
+				change = (old_best_path is not node.data['best_path']) and (old_best_path != node.data['best_path'])
 			
 		return [change, trend, node, replace_local_aggregate]
 
@@ -624,14 +917,22 @@ class CRouter:
 			if self.importFilter(pid, update.prefix, path):
 				tmppaths.append(self.importAction(pid, update.prefix, path))
 		
-		if tmppaths:
-			#Replace adjribin entry with new paths.
-			self.peers[pid].rib_in[update.prefix] = tmppaths
-		else:
-			self.peers[pid].rib_in.pop(update.prefix, None)
+		#Replace adjribin entry with new paths.
+		self.adj_rib_in.set(pid, update.prefix, tmppaths)
 				
 		#Schedule next event : rerun decision process for this prefix after processing delay
-		_event_Scheduler.add(CEvent(self.getIdelTime(), [self.id, update.prefix], EVENT_UPDATE))
+		if BATCH_DECISIONS:
+			if not self.batch_prefixes:
+				_event_Scheduler.add(CEvent(self.getIdelTime(), (self.id,), EVENT_BATCH_UPDATE))
+			self.batch_prefixes[update.prefix] = None
+			return
+		if COALESCE_UPDATES:
+			# The pending decision run will use the rib_in we just updated
+			if update.prefix in self.pending_updates:
+				self.num_coalesced_updates += 1
+				return
+			self.pending_updates.add(update.prefix)
+		_event_Scheduler.add(CEvent(self.getIdelTime(), (self.id, update.prefix), EVENT_UPDATE))
 
     #
     # Update routing tables to remove entries from down peer
@@ -639,7 +940,7 @@ class CRouter:
 	def peerDown(self, pid):
 		if SHOW_DEBUG:
 			print "peerDown", str(self), pid
-		prefixlist = self.peers[pid].rib_in.keys()
+		prefixlist = self.adj_rib_in.clearPeer(pid)
 		self.peers[pid].clear()
 		#Rerun decision process for each prefix whose nexthop is the failed peer
 		for p in prefixlist:
@@ -661,14 +962,17 @@ class CRouter:
 		else:
 			for p in self.loc_rib.prefixes():
 				if p not in self.filtered_prefixes or not DRAGON_ACTIVATED:
-					self.peer[pid].enqueue(p)
+					self.peers[pid].enqueue(p)
 					next_mrai = self.mraiExpires(pid, p)
 					if next_mrai < 0:
 						self.sendto(pid, p)
 	
 	def compute_local_aggregates(self):
 		
+		self.num_aggregates_computations += 1
+		start = time.time()
 		new_aggregates = wrapper.get_aggregates_pfxes(self.aggregate_tree)
+		self.aggregation_time += time.time() - start
 		
 		if RESTRICT_AGGREGATES_TO_PARENTLESS_PREFIXES:
 			new_aggregates = list(set(new_aggregates).intersection(set(parentless_prefixes)))
@@ -752,6 +1056,7 @@ class CRouter:
 	def update(self, prefix):
 		global SHOW_UPDATE_RIBS, CHECK_LOOP, SHOW_DEBUG, DRAGON_DEBUG, DRAGON_ACTIVATED
 		
+		self.num_decision_runs += 1
 		cur_node = self.loc_rib.search_exact(prefix)
 		
 		cur_type = None
@@ -796,7 +1101,9 @@ class CRouter:
 								break
 						if insert:
 							recompute_aggregates = True
+							start = time.time()
 							wrapper.insert_pfx(self.aggregate_tree, str(prefix), new_node.data['type'])
+							self.aggregation_time += time.time() - start
 
 				# First, check whether the current node can be
 				# filtered wrt its direct parent
@@ -836,7 +1143,9 @@ class CRouter:
 								break
 						if insert:
 							recompute_aggregates = True
+							start = time.time()
 							wrapper.insert_pfx(self.aggregate_tree, str(prefix), 4)
+							self.aggregation_time += time.time() - start
 				
 				## If the prefix was filtered
 				## Stop considering it filtered
@@ -869,9 +1178,14 @@ class CRouter:
 
 		# best path(s) changed: send new best path(s) to peers
 		if change:
+			if _changed_prefixes is not None:
+				_changed_prefixes.add(prefix)
 			if prefix not in self.filtered_prefixes:
-				for pid in self.peers:
-					self.presend2peer(pid, prefix)
+				if self.batching:
+					self.batch_send[prefix] = None
+				else:
+					for pid in self.peers:
+						self.presend2peer(pid, prefix)
 				
 				if CHECK_LOOP:
 					forwardingCheck(self, prefix)
@@ -890,7 +1204,34 @@ class CRouter:
 					if DRAGON_DEBUG:
 						print "%s %s DRAGON. Recomputing aggregates prefixes, now considering %s." %\
 						 (getSystemTimeStr(), self.id, prefix)
-					self.compute_local_aggregates()
+					if self.batching:
+						self.batch_aggregates = True
+					else:
+						self.compute_local_aggregates()
+
+	#
+	# Run the decision process for all the prefixes received since the batch was scheduled,
+	# then send the changes to each peer and recompute the aggregates only once
+	#
+	def updateBatch(self):
+		prefixes = self.batch_prefixes
+		self.batch_prefixes = OrderedDict()
+		self.batch_send = OrderedDict()
+		self.batch_aggregates = False
+		
+		self.batching = True
+		for prefix in prefixes:
+			self.update(prefix)
+		self.batching = False
+		
+		# Prefixes filtered later in the batch must not be sent
+		send = [prefix for prefix in self.batch_send if prefix not in self.filtered_prefixes]
+		if send:
+			for pid in self.peers:
+				self.presend2peerBatch(pid, send)
+		
+		if self.batch_aggregates:
+			self.compute_local_aggregates()
 	
 	def showRib(self, prefix):
 		tmpstr = getSystemTimeStr() + " RIB: " + str(self) + "*" + prefix
@@ -930,11 +1271,12 @@ class CRouter:
 		#Compute sending time
 		next_mrai = self.mraiExpires(pid, prefix)
 		if next_mrai < 0 and always_mrai:	# Need to reschedule msg sending
+			tprefix = prefix
 			if self.mrai_setting == MRAI_PEER_BASED:
 				tprefix = None
 			next_mrai = self.setMRAIvalue(pid, tprefix, self.peers[pid].random_mrai_wait())
 			if next_mrai > 0:
-				_event_Scheduler.add(CEvent(next_mrai, [self.id, pid, tprefix], EVENT_MRAI_EXPIRE_SENDTO))
+				self.scheduleMRAIExpiry(pid, tprefix, next_mrai)
 		
 		#If withdraw or if MRAI expired  Send immediately
 		if next_mrai < 0:# or self.isWithdrawal(pid, prefix):
@@ -945,8 +1287,40 @@ class CRouter:
 					print getSystemTimeStr(), self, pid, prefix, " Sending WITHDRAW immediately ...", pid
 			self.sendto(pid, prefix)
 		else: #do nothing, the scheduler will call sendto automatically when mrai timer expires
+			if self.mrai_setting == MRAI_PEER_BASED:
+				self.ensureMRAIExpiry(pid, None, next_mrai)
+			else:
+				self.ensureMRAIExpiry(pid, prefix, next_mrai)
 			if SHOW_DEBUG:
 				print getSystemTimeStr(), self, pid, prefix, " MRAI does not expire, wait...", formatTime(next_mrai - _systime)
+
+    #
+    # Add a set of prefixes to peer out_queue and check MRAI once
+    #
+	def presend2peerBatch(self, pid, prefixes):
+		if self.mrai_setting != MRAI_PEER_BASED:
+			for prefix in prefixes:
+				self.presend2peer(pid, prefix)
+			return
+		if self.getPeerLink(pid).status == LINK_DOWN:
+			return
+		for prefix in prefixes:
+			self.peers[pid].enqueue(prefix)
+		
+		next_mrai = self.mraiExpires(pid, None)
+		if next_mrai < 0 and always_mrai:
+			next_mrai = self.setMRAIvalue(pid, None, self.peers[pid].random_mrai_wait())
+			if next_mrai > 0:
+				self.scheduleMRAIExpiry(pid, None, next_mrai)
+		
+		if next_mrai < 0:
+			if SHOW_DEBUG:
+				print getSystemTimeStr(), self, pid, len(prefixes), "prefixes, MRAI expires, send immediately ...", pid
+			self.sendto(pid, None)
+		else:
+			self.ensureMRAIExpiry(pid, None, next_mrai)
+			if SHOW_DEBUG:
+				print getSystemTimeStr(), self, pid, len(prefixes), "prefixes, MRAI does not expire, wait...", formatTime(next_mrai - _systime)
     
 	#
     # Add locally originated prefix, and rerun decision process
@@ -959,8 +1333,8 @@ class CRouter:
 		npath = CPath()
 		npath.nexthop = self.id
 		npath.local_pref = default_local_preference
-		npath.community = [ATTRIBUTE_LOCAL]
-		self.origin_rib[prefix] = npath
+		npath.community = (ATTRIBUTE_LOCAL,)
+		self.origin_rib[prefix] = internPath(npath)
 		self.update(prefix)
 
 	#
@@ -980,25 +1354,19 @@ class CRouter:
 		sendsth = False
 		peer = self.peers[pid]
 		sendWithdraw = True
-		if len(peer.out_queue) > 0:
-			i = 0
-			#Traverse out_queue
-			while i < len(peer.out_queue):
-				if prefix is None:  #No prefix specified, MRAI peer based => send msg
-					if self.sendtopeer(pid, peer.out_queue[i]):
-						sendsth = True
-					if not self.isWithdrawal(pid, peer.out_queue[i]):
-						sendWithdraw = False
-					peer.out_queue.pop(i)
-				elif prefix == peer.out_queue[i]: #Prefix in outqueue correspond => send msg
-					if self.sendtopeer(pid, peer.out_queue[i]):
-						sendsth = True
-					if not self.isWithdrawal(pid, peer.out_queue[i]):
-						sendWithdraw = False
-					peer.out_queue.pop(i)
-					break
-				else: #Skip, prefix is not the one that was specified
-					i = i + 1
+		if prefix is None: #No prefix specified, MRAI peer based => send the whole out_queue, in order
+			prefixes = peer.out_queue.keys()
+			peer.out_queue.clear()
+		elif prefix in peer.out_queue: #Prefix in outqueue => send msg
+			prefixes = [prefix]
+			del peer.out_queue[prefix]
+		else:
+			prefixes = []
+		for p in prefixes:
+			if self.sendtopeer(pid, p):
+				sendsth = True
+			if not self.isWithdrawal(pid, p):
+				sendWithdraw = False
 		if sendsth: #Reset MRAI
 			#if SHOW_SEND_EVENTS:
 			#	print getSystemTimeStr(), "EVENT_SENDTO", self, "send", prefix, "to", pid
@@ -1010,7 +1378,7 @@ class CRouter:
 			#self.resetMRAI(pid, prefix)
 			next_mrai = self.setMRAI(pid, prefix)
 			if next_mrai > 0: 
-				_event_Scheduler.add(CEvent(next_mrai, [self.id, pid, prefix], EVENT_MRAI_EXPIRE_SENDTO))
+				self.scheduleMRAIExpiry(pid, prefix, next_mrai)
 				#print "Add EVENT_MRAI_EXPIRE_SENDTO ", str(self), pid, prefix, next_mrai
 		#else:
 		#	self.resetMRAI(pid, prefix)
@@ -1067,21 +1435,62 @@ class CRouter:
 				if DRAGON_DEBUG:
 					print "Do not propagate UPDATE further as ASN %s is a stub." % (pid)
 			else:
-				_event_Scheduler.add(CEvent(self.getPeerLink(pid).next_delivery_time(self.id, update.size()), [self.id, pid, update], EVENT_RECEIVE))
+				self.transmit(pid, update)
 		return change
 
+	#
+	# Put an update in flight on the link towards peer pid
+	#
+	def transmit(self, pid, update):
+		link = self.getPeerLink(pid)
+		event = CEvent(link.next_delivery_time(self.id, update.size()), (self.id, pid, update), EVENT_RECEIVE)
+		if SUPERSEDE_IN_FLIGHT:
+			link.in_flight[(self.id, update.prefix)] = event
+		if CANCEL_OBSOLETE_EVENTS:
+			link.pending.add(event)
+		if _router_partition is not None and not isLocalRouter(pid):
+			_outgoing_updates.append((event.time, event.seq, self.id, pid, update))
+			return
+		_event_Scheduler.add(event)
+
 	# Build update to send to peer pid for this prefix
 	# Normal BGP only
 	def sendtopeer(self, pid, prefix):
-		update = CUpdate(prefix)
+		update_group = self.peers[pid].update_group
+		if update_group is None:
+			self.buildUpdateGroups()
+			update_group = self.peers[pid].update_group
 		node = self.loc_rib.search_exact(prefix)
 		if node:
-			if self.exportFilter(pid, prefix, node.data['best_path']):
-				npath = self.exportAction(pid, prefix, node.data['best_path'])
-				update.paths.append(npath)
+			if self.exportLoopFilter(pid, node.data['best_path']):
+				update = update_group.export(self, pid, prefix, node.data['best_path'])
+			else:
+				update = CUpdate(prefix)
+		else:
+			update_group.exports.pop(prefix, None)
+			update = CUpdate(prefix)
 		# compare update and rib_out
 		return self.delivery(pid, prefix, update)
 
+    #
+    # Group the peers with the same outbound policy: session type, route
+    # reflector client flag and outbound route maps
+    #
+	def buildUpdateGroups(self):
+		update_groups = {}
+		for pid in sorted(self.peers):
+			peer = self.peers[pid]
+			if pid in _router_list:
+				ibgp = _router_list[pid].asn == self.asn
+			else: # unknown peer router, in a group of its own
+				ibgp = pid
+			# The outbound route maps in the order they are applied
+			key = (ibgp, peer.route_reflector_client, tuple(peer.getRouteMapOut()))
+			if key not in update_groups:
+				update_groups[key] = CUpdateGroup()
+			update_groups[key].peers.append(pid)
+			peer.update_group = update_groups[key]
+
     #
     # Compute processing delay based on configured delay fonction
     #
@@ -1125,27 +1534,112 @@ class CUpdate:
 			sz = sz + p.size()
 		return sz
 
+#
+# Represents an AS path as a node of a trie shared by all paths: a node holds
+# its first AS and points to the rest of the path, so that prepending an AS
+# returns the child node of the rest, created once. There is one node for each
+# AS path, and nodes compare as the tuple of their ASes. Nodes only hold weak
+# references to their children: a path no longer used by any path attribute (or
+# longer path) is freed.
+#
+class CASPath(object):
+	__slots__ = ('asn', 'tail', 'length', 'bloom', 'children', 'string', '__weakref__')
+
+	def __init__(self, asn=None, tail=None):
+		self.asn = asn
+		self.tail = tail
+		self.children = None # WeakValueDictionary, key: AS, value: node of the path prepended with the AS
+		self.string = None # see pathString
+		if tail is None:
+			self.length = 0
+			self.bloom = 0
+		else:
+			self.length = tail.length + 1
+			# Bloom filter of the ASes of the path, for loop detection
+			self.bloom = tail.bloom | (1 << (asn & 63))
+
+	def prepend(self, asn):
+		if self.children is None:
+			self.children = weakref.WeakValueDictionary()
+		child = self.children.get(asn)
+		if child is None:
+			child = CASPath(asn, self)
+			self.children[asn] = child
+		return child
+
+    #
+    # Returns the ASes of the path separated by underscores, for as-path route maps
+    #
+	def pathString(self):
+		if self.string is None:
+			self.string = "_".join([str(asn) for asn in self])
+		return self.string
+
+	def __len__(self):
+		return self.length
+
+	def __iter__(self):
+		node = self
+		while node.length > 0:
+			yield node.asn
+			node = node.tail
+
+	def __contains__(self, asn):
+		if not (self.bloom >> (asn & 63)) & 1:
+			return False
+		node = self
+		while node.length > 0:
+			if node.asn == asn:
+				return True
+			node = node.tail
+		return False
+
+	def __getitem__(self, i):
+		if i == 0 and self.length > 0:
+			return self.asn
+		return tuple(self)[i]
+
+	def __eq__(self, other):
+		if isinstance(other, CASPath):
+			return self is other
+		return tuple(self) == other
+
+	def __ne__(self, other):
+		return not self.__eq__(other)
+
+	__hash__ = object.__hash__
+
+	def __str__(self):
+		return str(tuple(self))
+
+	def __repr__(self):
+		return self.__str__()
+
+	# Unpickled paths are nodes of the trie of the process
+	def __reduce__(self):
+		return (asPath, (tuple(self),))
+
+_empty_aspath = CASPath()
+
+#
+# Returns the node of a sequence of ASes
+#
+def asPath(asns):
+	node = _empty_aspath
+	for asn in reversed(asns):
+		node = node.prepend(asn)
+	return node
+
 #
 # Represents a BGP Path
 #
-class CPath:
-	index = None # for single path routing, index=0; multipath routing, index=0,1,2,...
-	src_pid = None
-
-	#type = None
-	weight = None
-	local_pref = None
-	med = None
-	nexthop = None
-	community = None
-	alternative = None
-	igp_cost = None
-	aspath = None
-	fesnpath = None
+class CPath(object):
+	__slots__ = ('index', 'src_pid', 'weight', 'local_pref', 'med', 'nexthop', 'community', 'alternative',\
+		'igp_cost', 'aspath', 'fesnpath', 'rank_key', 'route_type', '__weakref__')
 
 	def __init__(self):
 		global default_local_preference, default_weight, ALTERNATIVE_NONE
-		self.index = 0
+		self.index = 0 # for single path routing, index=0; multipath routing, index=0,1,2,...
 		self.src_pid = None
 		#self.type = ANNOUNCEMENT
 		self.weight = default_weight
@@ -1153,9 +1647,12 @@ class CPath:
 		self.med = 0
 		self.nexthop = ""
 		self.igp_cost = 0
-		self.community = []
+		self.community = () # sorted tuple of int communities
 		self.alternative = ALTERNATIVE_NONE
-		self.aspath = ()
+		self.aspath = _empty_aspath
+		self.fesnpath = None
+		self.rank_key = None # see rankKey
+		self.route_type = None # first community, set by internPath
 
     #
     # Returns the size of the path in bytes
@@ -1191,6 +1688,21 @@ class CPath:
 		else:
 			return 0
 
+    #
+    # Ranking key: paths sort by key as compareTo orders them, except that MEDs
+    # are only part of the key with bgp_always_compare_med. The key is computed
+    # once, after import, and the path must not be modified afterwards.
+    #
+	def rankKey(self):
+		if self.rank_key is None:
+			if bgp_always_compare_med and len(self.aspath) > 0:
+				med = self.med
+			else:
+				med = 0
+			self.rank_key = (self.index, self.alternative == ALTERNATIVE_BACKUP, -self.weight, -self.local_pref,\
+				len(self.aspath), med, self.igp_cost, self.nexthop)
+		return self.rank_key
+
 	def compareTo2(self, path2):
 		result = self.compareTo(path2)
 		if result != 0:
@@ -1209,9 +1721,8 @@ class CPath:
 		self.med = p2.med
 		self.nexthop = p2.nexthop
 		self.igp_cost = p2.igp_cost
-		self.community = []
-		self.community.extend(p2.community)
-		self.aspath = p2.aspath[:]
+		self.community = p2.community
+		self.aspath = p2.aspath
 		self.alternative = p2.alternative
 
 	def __repr__(self):
@@ -1222,11 +1733,11 @@ class CPath:
 		tmpstr += "/COMM:["
 		if self.community:
 			for comm in self.community:
-				if comm == "1":
+				if comm == ATTRIBUTE_CUST:
 					tmpstr += "CUST"
-				elif comm == "2":
+				elif comm == ATTRIBUTE_PEER:
 					tmpstr += "PEER"
-				elif comm == "3":
+				elif comm == ATTRIBUTE_PROV:
 					tmpstr += "PROV"
 		tmpstr += "]"
 		return tmpstr
@@ -1276,6 +1787,239 @@ class CPath:
 		#	return self.ibgp_ebgp - other.ibgp_ebgp
 		return 0
 
+#
+# Interned path attributes: equal attribute sets share one CPath, which must not
+# be modified once interned. The store only holds weak references, so that the
+# paths no longer in any RIB or in-flight update are freed.
+#
+_path_attributes = weakref.WeakValueDictionary()
+
+def internPath(path):
+	key = (path.index, path.src_pid, path.weight, path.local_pref, path.med, path.nexthop,\
+		path.igp_cost, path.community, path.aspath, path.alternative)
+	shared = _path_attributes.get(key)
+	if shared is not None:
+		return shared
+	if path.community:
+		path.route_type = path.community[0]
+	path.rankKey()
+	_path_attributes[key] = path
+	return path
+
+#
+# Parse communities such as 2:3 into a sorted tuple of ints
+#
+def str2communities(str):
+	try:
+		return tuple(sorted([int(comm) for comm in str.split(":")]))
+	except ValueError:
+		print "Invalid community : ", str
+		sys.exit(-1)
+
+#
+# Incremental best path selection among the paths received for a prefix. The
+# best path is updated as paths are received, and only recomputed from the
+# paths of the prefix when the peer of the best path changes its paths. Paths
+# are compared on their ranking keys, then on peer rank as the stable sort of
+# pathSelection did.
+#
+class CPathSelection:
+	slots = None # key: pid, value: (peer rank, paths received from the peer)
+	best = None # best path, None if it must be recomputed
+	best_key = None # (ranking key, peer rank, index) of the best path
+	type_peers = None # key: route type, value: {pid: number of paths of that type}
+	meds = None # key: (neighbor AS, MED), value: number of paths
+	neighbor_meds = None # key: neighbor AS, value: number of different MEDs
+	med_conflicts = 0 # number of neighbor ASes with different MEDs
+
+	def __init__(self):
+		self.slots = {}
+		self.type_peers = {}
+		self.meds = {}
+		self.neighbor_meds = {}
+		self.med_conflicts = 0
+
+	def account(self, pid, paths, count):
+		for path in paths:
+			peers = self.type_peers.setdefault(path.route_type, {})
+			peers[pid] = peers.get(pid, 0) + count
+			if peers[pid] == 0:
+				del peers[pid]
+			if path.aspath:
+				self.accountMED(path.aspath[0], path.med, count)
+
+	def accountMED(self, neighbor, med, count):
+		num_paths = self.meds.get((neighbor, med), 0) + count
+		if num_paths:
+			self.meds[(neighbor, med)] = num_paths
+		else:
+			del self.meds[(neighbor, med)]
+		if num_paths == 0 or (num_paths == 1 and count == 1):
+			# The MED appeared or disappeared for the neighbor AS
+			num_meds = self.neighbor_meds.get(neighbor, 0) + count
+			if num_meds:
+				self.neighbor_meds[neighbor] = num_meds
+			else:
+				del self.neighbor_meds[neighbor]
+			if count == 1 and num_meds == 2:
+				self.med_conflicts += 1
+			elif count == -1 and num_meds == 1:
+				self.med_conflicts -= 1
+
+    #
+    # Replace the paths received from peer pid
+    #
+	def set(self, pid, rank, paths):
+		old = self.slots.pop(pid, None)
+		if old is not None:
+			self.account(pid, old[1], -1)
+			if self.best is not None and self.best_key[1] == rank:
+				self.best = None
+		if paths:
+			self.slots[pid] = (rank, paths)
+			self.account(pid, paths, 1)
+			if self.best is not None:
+				for i in range(len(paths)):
+					key = (paths[i].rankKey(), rank, i)
+					if key < self.best_key:
+						self.best = paths[i]
+						self.best_key = key
+
+	def getBest(self):
+		if self.best is None:
+			for (rank, paths) in self.slots.values():
+				for i in range(len(paths)):
+					key = (paths[i].rankKey(), rank, i)
+					if self.best is None or key < self.best_key:
+						self.best = paths[i]
+						self.best_key = key
+		return self.best
+
+    #
+    # Return the paths in the order of the peers
+    #
+	def orderedPaths(self):
+		paths = []
+		for (rank, peer_paths) in sorted(self.slots.values(), key=lambda slot: slot[0]):
+			paths.extend(peer_paths)
+		return paths
+
+    #
+    # Return [best path] when the ranking keys order the paths. Otherwise, MEDs
+    # are only compared between paths from the same neighbor AS, and all the
+    # paths are returned, in the order of the peers, to be sorted.
+    #
+	def selectedPaths(self):
+		if bgp_always_compare_med or self.med_conflicts == 0:
+			return [self.getBest()]
+		return self.orderedPaths()
+
+	def neighbors(self, route_type):
+		return set(self.type_peers.get(route_type, ()))
+
+#
+# Adj-RIB-In of a router. Paths are indexed by prefix, with one slot per peer
+# in the CPathSelection of the prefix, for the decision process. The rib_in of
+# each peer indexes the same paths by prefix, for session teardowns.
+#
+class CAdjRibIn:
+	peers = None # peers of the router
+	selections = None # key: prefix, value: CPathSelection
+	peer_ranks = None # key: pid, value: rank of the peer in peers
+
+	def __init__(self, peers):
+		self.peers = peers
+		self.selections = {}
+		self.peer_ranks = None
+
+    #
+    # Rank of peer pid in peers, which orders the paths of equal preference
+    #
+	def peerRank(self, pid):
+		if self.peer_ranks is None or len(self.peer_ranks) != len(self.peers):
+			if self.peer_ranks is not None:
+				# Peers were added: the order of peers may have changed
+				self.rebuild()
+			self.peer_ranks = dict([(peer_id, rank) for (rank, peer_id) in enumerate(self.peers)])
+		return self.peer_ranks[pid]
+
+    #
+    # Replace the paths received from peer pid for prefix
+    #
+	def set(self, pid, prefix, paths):
+		rib_in = self.peers[pid].rib_in
+		if paths:
+			rib_in[prefix] = paths
+		elif rib_in.pop(prefix, None) is None:
+			return
+		self.select(pid, prefix, paths)
+
+	def select(self, pid, prefix, paths):
+		selection = self.selections.get(prefix)
+		if selection is None:
+			selection = CPathSelection()
+			self.selections[prefix] = selection
+		selection.set(pid, self.peerRank(pid), paths)
+		if not selection.slots:
+			del self.selections[prefix]
+
+    #
+    # Remove the paths received from peer pid, and return their prefixes
+    #
+	def clearPeer(self, pid):
+		rib_in = self.peers[pid].rib_in
+		prefixes = rib_in.keys()
+		for prefix in prefixes:
+			self.select(pid, prefix, [])
+		rib_in.clear()
+		return prefixes
+
+    #
+    # Return the paths received for prefix (key: pid)
+    #
+	def paths(self, prefix):
+		selection = self.selections.get(prefix)
+		if selection is None:
+			return {}
+		return dict([(pid, paths) for (pid, (rank, paths)) in selection.slots.items()])
+
+    #
+    # Index again the rib_ins of the peers, after they were replaced
+    #
+	def rebuild(self):
+		self.peer_ranks = None
+		self.selections = {}
+		for (pid, peer) in self.peers.items():
+			for (prefix, paths) in peer.rib_in.items():
+				self.select(pid, prefix, paths)
+
+#
+# Update group: peers of a router with the same outbound policy. The path
+# exported for a best path is built once for the group, and the same CUpdate
+# is delivered to all its peers, which must not modify it.
+#
+class CUpdateGroup:
+	peers = None # ids of the peers of the group
+	exports = None # key: prefix, value: (best path, exported CUpdate)
+
+	def __init__(self):
+		self.peers = []
+		self.exports = {}
+
+    #
+    # Return the update of the group for best path of the prefix. pid is any
+    # peer of the group that passed the loop detection.
+    #
+	def export(self, router, pid, prefix, path):
+		export = self.exports.get(prefix)
+		if export is not None and export[0] is path:
+			return export[1]
+		update = CUpdate(prefix)
+		if router.exportRouteMapFilter(pid, prefix, path):
+			update.paths.append(router.exportAction(pid, prefix, path))
+		self.exports[prefix] = (path, update)
+		return update
+
 #
 # Represents a peer of a BGP router
 #
@@ -1283,13 +2027,14 @@ class CPeer:
 	id = None
 	rib_in = None # key: prefix, store the paths received from peer
 	rib_out = None # key: prefix, store the paths sent to peer
-	out_queue = None # store the updates hold by MRAI timer
+	out_queue = None # store the updates hold by MRAI timer, ordered set of prefixes (OrderedDict with None values)
 	rand_seed = None
 	mrai_base = None
 	route_reflector_client = None
 	route_map_in = None
 	route_map_out = None
 	route_map_sorted = None
+	update_group = None # CUpdateGroup, set by CRouter.buildUpdateGroups when a run starts
 	fesnList = None
 	sendFesnTable = None
 	
@@ -1304,7 +2049,7 @@ class CPeer:
 		self.link = l
 		self.rib_in = {}
 		self.rib_out = {}
-		self.out_queue = []
+		self.out_queue = OrderedDict()
 		self.mrai_base = 0
 		self.rand_seed = None
 		self.route_map_in = None
@@ -1315,7 +2060,7 @@ class CPeer:
 	def clear(self):
 		del self.rib_in; self.rib_in = {}
 		del self.rib_out; self.rib_out = {}
-		del self.out_queue; self.out_queue = []
+		del self.out_queue; self.out_queue = OrderedDict()
 
     #
     # Return computed value of the MRAI delay for this peer
@@ -1345,15 +2090,14 @@ class CPeer:
     # Add prefix to MRAI waiting sending queue.  Remove previous announcement because they are up to date
     #
 	def enqueue(self, prefix):
-		self.dequeue(prefix)
-		self.out_queue.append(prefix)
+		self.out_queue.pop(prefix, None)
+		self.out_queue[prefix] = None
 
     #
     # Remove prefix from MRAI waiting queue
     #
 	def dequeue(self, prefix):
-		if prefix in self.out_queue:
-			self.out_queue.remove(prefix)
+		self.out_queue.pop(prefix, None)
 
     #
     # return string representing path in adjribin for this prefix
@@ -1410,6 +2154,9 @@ class CLink:
 	rand_seed = None
 	next_delivery_time_start = None
 	next_delivery_time_end = None
+	in_flight = None # key: (sender id, prefix), latest EVENT_RECEIVE sent on the link
+	num_superseded = 0
+	pending = None # EVENT_RECEIVE not yet delivered, when obsolete events are cancelled
 
 	def __str__(self):
 		return str(self.start) + "-" + str(self.end)
@@ -1426,6 +2173,30 @@ class CLink:
 		self.rand_seed = None
 		self.next_deliver_time_start = 0
 		self.next_deliver_time_end = 0
+		self.in_flight = {}
+		self.num_superseded = 0
+		self.pending = set()
+
+    #
+    # Cancel the updates in flight on the link
+    #
+	def cancelPending(self):
+		for event in self.pending:
+			event.cancel()
+		self.pending.clear()
+
+    #
+    # Check if the in-flight update event sent by me has been superseded by a newer one
+    #
+	def superseded(self, me, prefix, event):
+		latest = self.in_flight.get((me, prefix))
+		if latest is None:
+			return False
+		if latest is not event:
+			self.num_superseded += 1
+			return True
+		del self.in_flight[(me, prefix)]
+		return False
 
     #
     # Return time of arrival at the other end of the link
@@ -1477,12 +2248,13 @@ class CLink:
 #
 # Represents a BGP route map, i.e.  BGP filter
 #
-class CRouteMap:
+class CRouteMap(object):
 	name = None
 	priority = None
 	permit = None
-	match = None
-	action = None
+	## Compiled by compile(), when match or action is set and once the config is loaded
+	rejects = None # function of (prefix, path), True if the path is denied. None if the map has actions
+	apply = None # function of (prefix, path), performs the actions on the path if it matches and returns it. None for filters
 
 	def __init__(self, n, pmt, pr):
 		self.name = n
@@ -1491,209 +2263,199 @@ class CRouteMap:
 		else:
 			self.permit = False
 		self.priority = pr
-		self.match = []
-		self.action = []
+		self._match = []
+		self._action = []
+		self.compile()
+
+	# Setting the conditions or actions compiles the route map again. Lists changed
+	# in place (as readConfig does) are only compiled by compile().
+	def getMatch(self):
+		return self._match
+
+	def setMatch(self, match):
+		self._match = match
+		self.compile()
+
+	def getAction(self):
+		return self._action
+
+	def setAction(self, action):
+		self._action = action
+		self.compile()
+
+	match = property(getMatch, setMatch)
+	action = property(getAction, setAction)
 
     #
-    # Check if this path match the route map conditions
+    # Compile the match conditions and actions in closures. Communities are parsed
+    # and regular expressions compiled here, rejects and apply call the closures.
     #
-	def isMatch(self, prefix, path):
-		i = 0
-		while i < len(self.match):
-			cond = self.match[i]
-			if cond[0] == "community-list":
-				if len(cond) >= 3 and cond[2] == "exact":
-					cmlist = cond[1].split(":")
-					cmlist.sort()
-					if cmlist != path.community:
-						return False
-				elif len(cond) >= 3 and cond[2] == "any":
-					cmlist = cond[1].split(":")
-					for comm in cmlist:
-						if comm in path.community:
-							return True
-					return False
-				elif cond[1] not in path.community:
-					return False
-			elif cond[0] == "as-path":
-				pathstr = array2str(path.aspath, "_")
-				if not re.compile(cond[1]).match(pathstr):
-					return False
-			elif cond[0] == "ip" and cnd[1] == "address":
-				if cond[2] != prefix:
-					return False
-			elif cond[0] == "metric":
-				if int(cond[1]) != path.med:
+	def compile(self):
+		match_funcs = [self.compileMatch(cond) for cond in self._match]
+		action_funcs = [self.compileAction(act) for act in self._action]
+		
+		def isMatch(prefix, path):
+			for match in match_funcs:
+				if not match(prefix, path):
 					return False
-			i = i + 1
+			return True
+		
+		def performAction(path):
+			for action in action_funcs:
+				action(path)
+			return path
+		
+		if len(action_funcs) == 0:
+			if self.permit:
+				self.rejects = lambda prefix, path: not isMatch(prefix, path)
+			else:
+				self.rejects = isMatch
+			self.apply = None
+		else:
+			self.rejects = None
+			if not self.permit:
+				self.apply = None
+			elif len(match_funcs) == 0:
+				self.apply = lambda prefix, path: performAction(path)
+			else:
+				def apply(prefix, path):
+					if isMatch(prefix, path):
+						return performAction(path)
+					return path
+				self.apply = apply
+
+	def compileMatch(self, cond):
+		if cond[0] == "community-list":
+			comms = str2communities(cond[1])
+			if len(cond) >= 3 and cond[2] == "exact":
+				return lambda prefix, path: path.community == comms
+			elif len(cond) >= 3 and cond[2] == "any":
+				comms = frozenset(comms)
+				return lambda prefix, path: not comms.isdisjoint(path.community)
+			elif len(comms) != 1:
+				return lambda prefix, path: False
+			else:
+				comm = comms[0]
+				return lambda prefix, path: comm in path.community
+		elif cond[0] == "as-path":
+			regex = re.compile(cond[1])
+			return lambda prefix, path: regex.match(path.aspath.pathString()) is not None
+		elif cond[0] == "ip" and cond[1] == "address":
+			address = cond[2]
+			return lambda prefix, path: prefix == address
+		elif cond[0] == "metric":
+			med = int(cond[1])
+			return lambda prefix, path: path.med == med
+		print "unknown route-map match", cond, "in route-map", self.name
+		sys.exit(-1)
+
+	def compileAction(self, act):
+		if act[0] == "local-preference":
+			local_pref = int(act[1])
+			def action(path):
+				path.local_pref = local_pref
+		elif act[0] == "community" and act[1] == "none":
+			def action(path):
+				path.community = ()
+		elif act[0] == "community" and len(act) >= 3 and act[2] == "additive":
+			comms = str2communities(act[1])
+			def action(path):
+				path.community = tuple(sorted(path.community + comms))
+		elif act[0] == "community":
+			comms = str2communities(act[1])
+			def action(path):
+				path.community = comms
+		elif act[0] == "as-path" and act[1] == "prepend":
+			asns = [int(asn) for asn in reversed(act[2:])]
+			def action(path):
+				for asn in asns:
+					path.aspath = path.aspath.prepend(asn)
+		elif act[0] == "metric":
+			med = int(act[1])
+			def action(path):
+				path.med = med
+		else:
+			print "unknown route-map set", act, "in route-map", self.name
+			sys.exit(-1)
+		return action
+
+    #
+    # Check if this path match the route map conditions (as they are now, the
+    # compiled ones are used by rejects and apply)
+    #
+	def isMatch(self, prefix, path):
+		for cond in self._match:
+			if not self.compileMatch(cond)(prefix, path):
+				return False
 		return True
 
     #
-    # Perform action of the route map on the path
+    # Perform action of the route map on the path (as they are now)
     #
 	def performAction(self, path):
-		i = 0
-		while i < len(self.action):
-			act = self.action[i]
-			if act[0] == "local-preference":
-				path.local_pref = int(act[1])
-			elif act[0] == "community":
-				if act[1] == "none":
-					path.community = []
-				else:
-					if len(act) >= 3 and act[2] == "additive":
-						path.community.extend(act[1].split(":"))
-					else:
-						path.community = act[1].split(":")
-					path.community.sort()
-			elif act[0] == "as-path" and act[1] == "prepend":
-				j = 0
-				while j < len(act) - 2:
-					path.aspath.insert(j, int(act[2+j]))
-					j = j + 1
-			elif act[0] == "metric":
-				path.med = int(act[1])
-			i = i + 1
+		for act in self._action:
+			self.compileAction(act)(path)
 		return path
 
+	# Closures are not pickled, snapshots compile the route map again
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		for attr in ['rejects', 'apply']:
+			state.pop(attr, None)
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.compile()
+
 #
-# Represents a BGP event
+# Represents a BGP event. Events are compact records: the parameters are stored
+# as an immutable tuple, and processing is dispatched on the event type.
 #
-class CEvent:
-	seq = 0 # sequence
-	time = None # when
-	param = None # where
-	type = None # what
+class CEvent(object):
+	__slots__ = ('seq', 'time', 'param', 'type', 'cancelled')
 
-	def __init__(self, tm, pr, t):
-		self.seq = getSequence()
+	def __init__(self, tm, pr, t, seq=None):
+		if seq is None:
+			seq = getSequence()
+		self.seq = seq
 		self.time = tm
-		self.param = pr
-		self.type = t
+		if type(pr) is list:
+			pr = tuple(pr)
+		self.param = pr # where
+		self.type = t # what
+		self.cancelled = False
+
+    #
+    # Mark the event as dead. It stays in the scheduler and is skipped when popped.
+    #
+	def cancel(self):
+		global _cancelled_events
+		if not self.cancelled:
+			self.cancelled = True
+			_cancelled_events += 1
 
     #
     # Print event representation on stdout
     #
 	def showEvent(self):
-		global SHOW_RECEIVE_EVENTS, _router_list, SHOW_DEBUG
-		if self.type == EVENT_RECEIVE:
-			[rtid, rvid, update] = self.param
-			if SHOW_RECEIVE_EVENTS:
-				print formatTime(self.time), str(_router_list[rvid]), "receive", str(_router_list[rtid]), update
-		elif self.type == EVENT_UPDATE:
-			[rtid, prefix] = self.param
-			#print self.time, rtid, "update", prefix
-		elif self.type == EVENT_MRAI_EXPIRE_SENDTO:
-			[sdid, rvid, prefix] = self.param
-			if SHOW_DEBUG:
-				print formatTime(self.time), sdid, "mrai expires", rvid, prefix
-		elif self.type == EVENT_LINK_DOWN:
-			[rt1, rt2] = self.param
-			if SHOW_LINK_EVENTS:
-				print formatTime(self.time), "link", str(_router_list[rt1]), "-", str(_router_list[rt2]), "down"
-		elif self.type == EVENT_LINK_UP:
-			[rt1, rt2] = self.param
-			if SHOW_LINK_EVENTS:
-				print formatTime(self.time), "link", str(_router_list[rt1]), "-", str(_router_list[rt2]), "up"
-		elif self.type == EVENT_ANNOUNCE_PREFIX:
-			[rtid, prefix] = self.param
-		elif self.type == EVENT_WITHDRAW_PREFIX:
-			[rtid, prefix] = self.param
-			print formatTime(self.time), "router", str(_router_list[rtid]), "withdraws", prefix
-		elif self.type == EVENT_TERMINATE:
-			print formatTime(self.time), "simulation terminates"
-		elif self.type == EVENT_SHOW_ALL_RIBS:
-			print formatTime(self.time), "printing the content of all the RIBS ..."
-		elif self.type == EVENT_RESET_COUNTERS:
-			if SHOW_DEBUG:
-				print formatTime(self.time), "resetting all the counters ..."
-		elif self.type == EVENT_ACTIVATE_DEAGGREGATES:
-			if SHOW_DEBUG:
-				print formatTime(self.time), "activating de-aggregates announcements ..."
-		elif self.type == EVENT_OUTPUT_UPDATES:
-			print formatTime(self.time), "output numbers of updates to file ..."
-		elif self.type == EVENT_ACTIVATE_DEBUG:
-			print formatTime(self.time), "activating DEBUG mode ..."
-		elif self.type == EVENT_START_TRACK_TIME:
-			print formatTime(self.time), "resetting counter for accounting for simulation time ..."
-		elif self.type == EVENT_STOP_TRACK_TIME:
-			print formatTime(self.time), "outputting simulation time since last event ..."
-		else:
-			if SHOW_DEBUG:
-				print formatTime(self.time), "unknown event ..."
+		show = _event_printers.get(self.type)
+		if show is not None:
+			show(self)
+		elif SHOW_DEBUG:
+			print formatTime(self.time), "unknown event ..."
 
     #
     # Perform corresponding action when the event happens
     #
 	def process(self):
-		global _router_list, DISABLE_DEAGGREGATES_ANNOUNCEMENT, start_time, cur_time
-		
-		global DRAGON_DEBUG
-		global SHOW_SEND_EVENTS
-		global SHOW_DEBUG
-		global SHOW_LINK_EVENTS
-		global SHOW_ANNOUNCE_EVENTS
-		
-		self.showEvent()
-		if self.type == EVENT_RECEIVE:
-			[rtid, rvid, update] = self.param
-			_router_list[rvid].receive(rtid, update)
-		elif self.type == EVENT_UPDATE:
-			[rtid, prefix] = self.param
-			_router_list[rtid].update(prefix)
-		elif self.type == EVENT_MRAI_EXPIRE_SENDTO:
-			[sdid, rvid, prefix] = self.param
-			_router_list[sdid].resetMRAI(rvid, prefix)
-			_router_list[sdid].sendto(rvid, prefix)
-		elif self.type == EVENT_LINK_DOWN:
-			[rt1, rt2] = self.param
-			lk = getRouterLink(rt1, rt2)
-			lk.status = LINK_DOWN
-			_router_list[rt1].peerDown(rt2)
-			_router_list[rt2].peerDown(rt1)
-		elif self.type == EVENT_LINK_UP:
-			[rt1, rt2] = self.param
-			lk = getRouterLink(rt1, rt2)
-			lk.status = LINK_UP
-			_router_list[rt1].peerUp(rt2)
-			_router_list[rt2].peerUp(rt1)
-		elif self.type == EVENT_ANNOUNCE_PREFIX:
-			[rtid, prefix] = self.param
-			if DRAGON_ACTIVATED:
-				_router_list[rtid].compute_local_announcements(prefix)
-			else:
-				_router_list[rtid].announce_prefix(prefix)
-		elif self.type == EVENT_WITHDRAW_PREFIX:
-			[rtid, prefix] = self.param
-			_router_list[rtid].withdraw_prefix(prefix)
-		elif self.type == EVENT_TERMINATE:
-			return -1
-		elif self.type == EVENT_SHOW_ALL_RIBS:
-			print "-----======$$$$$$$$ ALL_RIBS $$$$$$$$$=======------"
-			for rt in sorted(_router_list.values(), key=lambda router: router.asn):
-				rt.showAllRib()
-		elif self.type == EVENT_RESET_COUNTERS:
-			for rt in _router_list.values():
-				for neighbor in rt.num_updates:
-					rt.num_updates[neighbor] = 0
-		elif self.type == EVENT_ACTIVATE_DEAGGREGATES:
-			DISABLE_DEAGGREGATES_ANNOUNCEMENT = False
-		elif self.type == EVENT_OUTPUT_UPDATES:
-			[filename] = self.param
-			output_number_updates(filename)
-		elif self.type == EVENT_ACTIVATE_DEBUG:
-			DRAGON_DEBUG = True
-			SHOW_SEND_EVENTS = True
-			SHOW_DEBUG = True
-			SHOW_LINK_EVENTS = True
-			SHOW_ANNOUNCE_EVENTS = True
-		elif self.type == EVENT_START_TRACK_TIME:
-			start_time = float(formatTime(self.time))
-			cur_time = start_time
-		elif self.type == EVENT_STOP_TRACK_TIME:
-			[filename, in_cone] = self.param
-			output_processing_time(filename, in_cone)
-		return 0
+		# Frequent events only print in trace mode
+		if SHOW_RECEIVE_EVENTS or SHOW_DEBUG or self.type not in _silent_events:
+			self.showEvent()
+		handler = _event_handlers.get(self.type)
+		if handler is None:
+			return 0
+		return handler(self)
 
     #
     # Compare two event, based on happening time
@@ -1703,9 +2465,231 @@ class CEvent:
 			return self.time - o.time
 		return self.seq - o.seq
 
-#
-# Represents an ordered list
-#
+######################
+## Event printers    #
+######################
+
+def showReceiveEvent(event):
+	if SHOW_RECEIVE_EVENTS:
+		(rtid, rvid, update) = event.param
+		print formatTime(event.time), str(_router_list[rvid]), "receive", str(_router_list[rtid]), update
+
+def showMRAIExpireEvent(event):
+	if SHOW_DEBUG:
+		(sdid, rvid, prefix) = event.param
+		print formatTime(event.time), sdid, "mrai expires", rvid, prefix
+
+def showLinkDownEvent(event):
+	if SHOW_LINK_EVENTS:
+		(rt1, rt2) = event.param
+		print formatTime(event.time), "link", str(_router_list[rt1]), "-", str(_router_list[rt2]), "down"
+
+def showLinkUpEvent(event):
+	if SHOW_LINK_EVENTS:
+		(rt1, rt2) = event.param
+		print formatTime(event.time), "link", str(_router_list[rt1]), "-", str(_router_list[rt2]), "up"
+
+def showWithdrawPrefixEvent(event):
+	(rtid, prefix) = event.param
+	print formatTime(event.time), "router", str(_router_list[rtid]), "withdraws", prefix
+
+def showNothing(event):
+	pass
+
+def showMessage(message, debug=False):
+	def show(event):
+		if SHOW_DEBUG or not debug:
+			print formatTime(event.time), message
+	return show
+
+_event_printers = {
+	EVENT_RECEIVE: showReceiveEvent,
+	EVENT_UPDATE: showNothing,
+	EVENT_BATCH_UPDATE: showNothing,
+	EVENT_MRAI_EXPIRE_SENDTO: showMRAIExpireEvent,
+	EVENT_MRAI_WHEEL: showNothing,
+	EVENT_LINK_DOWN: showLinkDownEvent,
+	EVENT_LINK_UP: showLinkUpEvent,
+	EVENT_ANNOUNCE_PREFIX: showNothing,
+	EVENT_WITHDRAW_PREFIX: showWithdrawPrefixEvent,
+	EVENT_TERMINATE: showMessage("simulation terminates"),
+	EVENT_SHOW_ALL_RIBS: showMessage("printing the content of all the RIBS ..."),
+	EVENT_RESET_COUNTERS: showMessage("resetting all the counters ...", debug=True),
+	EVENT_ACTIVATE_DEAGGREGATES: showMessage("activating de-aggregates announcements ...", debug=True),
+	EVENT_OUTPUT_UPDATES: showMessage("output numbers of updates to file ..."),
+	EVENT_ACTIVATE_DEBUG: showMessage("activating DEBUG mode ..."),
+	EVENT_START_TRACK_TIME: showMessage("resetting counter for accounting for simulation time ..."),
+	EVENT_STOP_TRACK_TIME: showMessage("outputting simulation time since last event ..."),
+}
+
+# Events that print nothing unless SHOW_RECEIVE_EVENTS or SHOW_DEBUG is set
+_silent_events = frozenset([EVENT_RECEIVE, EVENT_UPDATE, EVENT_BATCH_UPDATE, EVENT_MRAI_EXPIRE_SENDTO, EVENT_MRAI_WHEEL])
+
+######################
+## Event handlers    #
+######################
+
+def processReceiveEvent(event):
+	(rtid, rvid, update) = event.param
+	if CANCEL_OBSOLETE_EVENTS:
+		getRouterLink(rtid, rvid).pending.discard(event)
+	if SUPERSEDE_IN_FLIGHT and getRouterLink(rtid, rvid).superseded(rtid, update.prefix, event):
+		# Dropped like a cancelled event, and thus not traced
+		event.cancelled = True
+		return 0
+	_router_list[rvid].receive(rtid, update)
+	return 0
+
+def processUpdateEvent(event):
+	(rtid, prefix) = event.param
+	router = _router_list[rtid]
+	router.pending_updates.discard(prefix)
+	router.update(prefix)
+	return 0
+
+def processBatchUpdateEvent(event):
+	(rtid,) = event.param
+	_router_list[rtid].updateBatch()
+	return 0
+
+def processMRAIExpireEvent(event):
+	(sdid, rvid, prefix) = event.param
+	if _router_list[sdid].mrai_events.get((rvid, prefix)) is event:
+		del _router_list[sdid].mrai_events[(rvid, prefix)]
+	_router_list[sdid].resetMRAI(rvid, prefix)
+	_router_list[sdid].sendto(rvid, prefix)
+	return 0
+
+def processMRAIWheelEvent(event):
+	(rtid,) = event.param
+	_router_list[rtid].expireMRAIWheel(event)
+	return 0
+
+def processLinkDownEvent(event):
+	(rt1, rt2) = event.param
+	lk = getRouterLink(rt1, rt2)
+	lk.status = LINK_DOWN
+	if CANCEL_OBSOLETE_EVENTS:
+		# Updates in flight are lost and the MRAI timers of the session are reset
+		lk.cancelPending()
+		for (rt, peer) in [(rt1, rt2), (rt2, rt1)]:
+			for (pid, prefix) in _router_list[rt].pendingMRAIExpiries():
+				if pid == peer:
+					_router_list[rt].cancelMRAIExpiry(pid, prefix)
+					_router_list[rt].resetMRAI(pid, prefix)
+	if isLocalRouter(rt1):
+		_router_list[rt1].peerDown(rt2)
+	if isLocalRouter(rt2):
+		_router_list[rt2].peerDown(rt1)
+	return 0
+
+def processLinkUpEvent(event):
+	(rt1, rt2) = event.param
+	lk = getRouterLink(rt1, rt2)
+	lk.status = LINK_UP
+	if isLocalRouter(rt1):
+		_router_list[rt1].peerUp(rt2)
+	if isLocalRouter(rt2):
+		_router_list[rt2].peerUp(rt1)
+	return 0
+
+def processAnnouncePrefixEvent(event):
+	(rtid, prefix) = event.param
+	if DRAGON_ACTIVATED:
+		_router_list[rtid].compute_local_announcements(prefix)
+	else:
+		_router_list[rtid].announce_prefix(prefix)
+	return 0
+
+def processWithdrawPrefixEvent(event):
+	(rtid, prefix) = event.param
+	_router_list[rtid].withdraw_prefix(prefix)
+	return 0
+
+def processTerminateEvent(event):
+	return -1
+
+def processShowAllRibsEvent(event):
+	print "-----======$$$$$$$$ ALL_RIBS $$$$$$$$$=======------"
+	for rt in sorted(_router_list.values(), key=lambda router: router.asn):
+		rt.showAllRib()
+	return 0
+
+def processResetCountersEvent(event):
+	for rt in _router_list.values():
+		for neighbor in rt.num_updates:
+			rt.num_updates[neighbor] = 0
+		rt.num_coalesced_updates = 0
+	return 0
+
+def processActivateDeaggregatesEvent(event):
+	global DISABLE_DEAGGREGATES_ANNOUNCEMENT
+	DISABLE_DEAGGREGATES_ANNOUNCEMENT = False
+	return 0
+
+def processOutputUpdatesEvent(event):
+	(filename,) = event.param
+	output_number_updates(filename)
+	return 0
+
+def processActivateDebugEvent(event):
+	global DRAGON_DEBUG, SHOW_SEND_EVENTS, SHOW_DEBUG, SHOW_LINK_EVENTS, SHOW_ANNOUNCE_EVENTS
+	DRAGON_DEBUG = True
+	SHOW_SEND_EVENTS = True
+	SHOW_DEBUG = True
+	SHOW_LINK_EVENTS = True
+	SHOW_ANNOUNCE_EVENTS = True
+	return 0
+
+def processStartTrackTimeEvent(event):
+	global start_time, cur_time
+	start_time = float(formatTime(event.time))
+	cur_time = start_time
+	return 0
+
+def processStopTrackTimeEvent(event):
+	(filename, in_cone) = event.param
+	output_processing_time(filename, in_cone)
+	return 0
+
+_event_handlers = {
+	EVENT_RECEIVE: processReceiveEvent,
+	EVENT_UPDATE: processUpdateEvent,
+	EVENT_BATCH_UPDATE: processBatchUpdateEvent,
+	EVENT_MRAI_EXPIRE_SENDTO: processMRAIExpireEvent,
+	EVENT_MRAI_WHEEL: processMRAIWheelEvent,
+	EVENT_LINK_DOWN: processLinkDownEvent,
+	EVENT_LINK_UP: processLinkUpEvent,
+	EVENT_ANNOUNCE_PREFIX: processAnnouncePrefixEvent,
+	EVENT_WITHDRAW_PREFIX: processWithdrawPrefixEvent,
+	EVENT_TERMINATE: processTerminateEvent,
+	EVENT_SHOW_ALL_RIBS: processShowAllRibsEvent,
+	EVENT_RESET_COUNTERS: processResetCountersEvent,
+	EVENT_ACTIVATE_DEAGGREGATES: processActivateDeaggregatesEvent,
+	EVENT_OUTPUT_UPDATES: processOutputUpdatesEvent,
+	EVENT_ACTIVATE_DEBUG: processActivateDebugEvent,
+	EVENT_START_TRACK_TIME: processStartTrackTimeEvent,
+	EVENT_STOP_TRACK_TIME: processStopTrackTimeEvent,
+}
+
+#
+# Keep track of the number of pending events per type, and of the prefixes
+# allocated by EVENT_ANNOUNCE_PREFIX events (DRAGON)
+#
+def trackEvent(o):
+	_pending_events[o.type] += 1
+	if _pending_events[o.type] > _perf_peak[o.type]:
+		_perf_peak[o.type] = _pending_events[o.type]
+	if DRAGON_ACTIVATED:
+		if o.type == EVENT_ANNOUNCE_PREFIX:
+			originator = o.param[0]
+			pfx = o.param[1]
+			allocated_prefixes.add(pfx)
+			router2prefix_mapping[originator].append(pfx)
+
+#
+# Represents an ordered list
+#
 class COrderedList:
 	data = [];
 	#
@@ -1718,15 +2702,10 @@ class COrderedList:
 	# Insert object o in the correct position in the ordered list, dichotomical search. Do nothing is object is present
 	# 
 	def add(self, o):
-		
-		## DRAGON
-		if DRAGON_ACTIVATED:
-			if o.type == EVENT_ANNOUNCE_PREFIX:
-				originator = o.param[0]
-				pfx = o.param[1]
-				allocated_prefixes.add(pfx)
-				router2prefix_mapping[originator].append(pfx)
-		
+		trackEvent(o)
+		self.insert(o)
+
+	def insert(self, o):
 		start = 0;
 		end = len(self.data)-1;
 		while start <= end:
@@ -1766,6 +2745,283 @@ class COrderedList:
 	def pop(self, idx):
 		return self.data.pop(idx);
 
+#
+# Represents a binary heap of events, ordered by (time, seq) like CEvent.__cmp__
+#
+class CEventHeap:
+	data = None
+
+	def __init__(self):
+		self.data = []
+
+	#
+	# Push event o in O(log n)
+	#
+	def add(self, o):
+		trackEvent(o)
+		self.insert(o)
+
+	def insert(self, o):
+		heapq.heappush(self.data, (o.time, o.seq, o))
+
+	#
+	# Only the head of the heap (idx 0) is ordered
+	#
+	def __getitem__(self, idx):
+		if idx != 0:
+			raise IndexError("CEventHeap only gives access to its first event")
+		return self.data[0][2]
+
+	def __len__(self):
+		return len(self.data)
+
+	#
+	# Remove and return the earliest event in O(log n)
+	#
+	def pop(self, idx=0):
+		if idx != 0:
+			raise IndexError("CEventHeap can only pop its first event")
+		return heapq.heappop(self.data)[2]
+
+#
+# Return the calendar bucket width derived from the default delay functions
+#
+def calendarWidth():
+	return max(toSystemTime(min(delayfuncMean(default_link_delay_func), delayfuncMean(default_process_delay_func))), 1)
+
+#
+# Represents a calendar queue (Brown, 1988) of events, ordered by (time, seq) like CEvent.__cmp__.
+# Events of the same bucket-sized "day" share a bucket, and a bucket holds the days
+# congruent modulo the number of buckets (one "year"). Enqueue and dequeue are amortised O(1)
+# when the bucket width matches the separation between consecutive events.
+#
+class CCalendarQueue:
+	buckets = None
+	width = None
+	fixed_width = False
+	cur_day = 0
+	size = 0
+
+	MIN_BUCKETS = 2
+	WIDTH_SAMPLE = 25
+
+	def __init__(self, width=None):
+		self.width = width
+		self.fixed_width = width is not None
+		self.size = 0
+		self.cur_day = 0
+		self.buckets = [[] for i in range(self.MIN_BUCKETS)]
+
+	def day(self, tm):
+		return int(tm // self.width)
+
+	def add(self, o):
+		trackEvent(o)
+		self.insert(o)
+
+	def insert(self, o):
+		if self.width is None:
+			self.width = calendarWidth()
+		entry = (o.time, o.seq, o)
+		day = self.day(o.time)
+		bisect.insort(self.buckets[day % len(self.buckets)], entry)
+		if day < self.cur_day or self.size == 0:
+			self.cur_day = day
+		self.size = self.size + 1
+		if self.size > 2*len(self.buckets):
+			self.resize(2*len(self.buckets))
+
+	#
+	# Return the bucket holding the earliest event, moving the current day up to it
+	#
+	def head(self):
+		if self.size == 0:
+			raise IndexError("empty calendar queue")
+		nbuckets = len(self.buckets)
+		for i in xrange(nbuckets):
+			bucket = self.buckets[self.cur_day % nbuckets]
+			if bucket and self.day(bucket[0][0]) <= self.cur_day:
+				return bucket
+			self.cur_day = self.cur_day + 1
+		# Nothing in a whole year: jump directly to the earliest event
+		bucket = min([b for b in self.buckets if b], key=lambda b: b[0])
+		self.cur_day = self.day(bucket[0][0])
+		return bucket
+
+	def __getitem__(self, idx):
+		if idx != 0:
+			raise IndexError("CCalendarQueue only gives access to its first event")
+		return self.head()[0][2]
+
+	def __len__(self):
+		return self.size
+
+	def pop(self, idx=0):
+		if idx != 0:
+			raise IndexError("CCalendarQueue can only pop its first event")
+		entry = self.head().pop(0)
+		self.size = self.size - 1
+		if len(self.buckets) > self.MIN_BUCKETS and self.size < len(self.buckets)/2:
+			self.resize(len(self.buckets)/2)
+		return entry[2]
+
+	#
+	# Rebuild the calendar with nbuckets buckets. Unless configured, the bucket width
+	# is re-tuned to three times the average separation of the earliest events.
+	#
+	def resize(self, nbuckets):
+		entries = []
+		for bucket in self.buckets:
+			entries.extend(bucket)
+		entries.sort()
+		if not self.fixed_width:
+			self.width = self.sampleWidth(entries[:self.WIDTH_SAMPLE])
+		self.buckets = [[] for i in range(nbuckets)]
+		for entry in entries:
+			self.buckets[self.day(entry[0]) % nbuckets].append(entry)
+		if entries:
+			self.cur_day = self.day(entries[0][0])
+
+	def sampleWidth(self, sample):
+		separations = [sample[i+1][0] - sample[i][0] for i in range(len(sample) - 1)]
+		if not separations:
+			return self.width
+		average = sum(separations)/len(separations)
+		# Ignore the outliers, as proposed by Brown
+		separations = [sep for sep in separations if sep <= 2*average]
+		if not separations or sum(separations) <= 0:
+			return self.width
+		return 3.0*sum(separations)/len(separations)
+
+#
+# Build an empty event scheduler of the given kind
+#
+def newEventScheduler(kind):
+	if kind == SCHEDULER_LIST:
+		return COrderedList()
+	elif kind == SCHEDULER_HEAP:
+		return CEventHeap()
+	elif kind == SCHEDULER_CALENDAR:
+		return CCalendarQueue(CALENDAR_WIDTH)
+	else:
+		print "Unsupported event scheduler", kind
+		sys.exit(-1)
+
+#
+# Switch the event scheduler, keeping the pending events
+#
+def setEventScheduler(kind, width=None):
+	global _event_Scheduler, EVENT_SCHEDULER, CALENDAR_WIDTH
+	EVENT_SCHEDULER = kind
+	CALENDAR_WIDTH = width
+	scheduler = newEventScheduler(kind)
+	while len(_event_Scheduler) > 0:
+		scheduler.insert(_event_Scheduler.pop(0))
+	_event_Scheduler = scheduler
+
+#
+# Represents a hierarchical timer wheel (Varghese and Lauck, 1987) of keyed timers, with at
+# most one timer per key. Level 0 slots are WHEEL_TICK system time units wide, and each level
+# has WHEEL_SLOTS slots of the width of the whole level below. A timer is put in the lowest
+# level whose slots cover its deadline from the current time, and the slot of the earliest
+# deadline is cascaded to the lower levels when it is reached. Slots are sparse: only the
+# slots holding timers exist.
+#
+class CTimerWheel:
+	timers = None # key: timer key, value: (deadline, seq, level, slot)
+	levels = None # one dict per level, key: slot number, value: {timer key: (deadline, seq)}
+	cur_tick = 0
+	seq = 0
+
+	WHEEL_TICK_BITS = 10 # about 1ms
+	WHEEL_SLOT_BITS = 6 # 64 slots per level
+	WHEEL_LEVELS = 4 # level 3 also holds the timers beyond its 64 slots
+
+	def __init__(self):
+		self.timers = {}
+		self.levels = [{} for i in range(self.WHEEL_LEVELS)]
+		self.cur_tick = 0
+		self.seq = 0
+
+	def __len__(self):
+		return len(self.timers)
+
+	def __contains__(self, key):
+		return key in self.timers
+
+	def keys(self):
+		return self.timers.keys()
+
+	def schedule(self, key, deadline):
+		if key in self.timers:
+			if self.timers[key][0] == deadline:
+				return
+			self.cancel(key)
+		self.seq += 1
+		self.insert(key, deadline, self.seq)
+
+	def insert(self, key, deadline, seq):
+		tick = max(int(deadline) >> self.WHEEL_TICK_BITS, self.cur_tick)
+		level = min(((tick ^ self.cur_tick).bit_length() - 1) // self.WHEEL_SLOT_BITS, self.WHEEL_LEVELS - 1)
+		level = max(level, 0)
+		slot = tick >> (level*self.WHEEL_SLOT_BITS)
+		self.levels[level].setdefault(slot, {})[key] = (deadline, seq)
+		self.timers[key] = (deadline, seq, level, slot)
+
+	def cancel(self, key):
+		timer = self.timers.pop(key, None)
+		if timer is not None:
+			(deadline, seq, level, slot) = timer
+			timers = self.levels[level][slot]
+			del timers[key]
+			if not timers:
+				del self.levels[level][slot]
+
+    #
+    # Cascade the slot of the earliest deadline down to level 0, and return it
+    #
+	def earliestSlot(self):
+		for level in range(self.WHEEL_LEVELS):
+			if self.levels[level]:
+				break
+		else:
+			return None
+		slot = min(self.levels[level])
+		while level > 0:
+			timers = self.levels[level].pop(slot)
+			self.cur_tick = max(self.cur_tick, slot << (level*self.WHEEL_SLOT_BITS))
+			for (key, (deadline, seq)) in timers.items():
+				self.insert(key, deadline, seq)
+			level = 0
+			while not self.levels[level]:
+				level += 1
+			slot = min(self.levels[level])
+		return self.levels[0][slot]
+
+	def nextDeadline(self):
+		timers = self.earliestSlot()
+		if timers is None:
+			return None
+		return min(timers.values())[0]
+
+    #
+    # Remove the timers due at time now, and return their keys by deadline
+    #
+	def expire(self, now):
+		expired = []
+		while True:
+			timers = self.earliestSlot()
+			if timers is None:
+				break
+			due = [(timer, key) for (key, timer) in timers.items() if timer[0] <= now]
+			if not due:
+				break
+			for (timer, key) in due:
+				self.cancel(key)
+			expired.extend(due)
+		expired.sort()
+		return [key for (timer, key) in expired]
+
 def getRouterLink(id1, id2):
 	global _router_graph
 	if id1 > id2:
@@ -1929,7 +3185,8 @@ def activate_debug():
 def readConfig(lines):
 	global SHOW_UPDATE_RIBS, SHOW_RECEIVE_EVENTS, SHOW_FINAL_RIBS, wrate, always_mrai, ssld,\
 		bgp_always_compare_med, MRAI_JITTER, MAX_PATH_NUMBER, CHECK_LOOP, SHOW_DEBUG, RANDOMIZED_KEY,\
-		SHOW_SEND_EVENTS, default_link_delay_func, default_process_delay_func, _link_delay_table
+		SHOW_SEND_EVENTS, default_link_delay_func, default_process_delay_func, _link_delay_table, COALESCE_UPDATES, SUPERSEDE_IN_FLIGHT, BATCH_DECISIONS,\
+		CANCEL_OBSOLETE_EVENTS, QUIESCENCE_DETECTION, PERF_REPORT, EVENT_TRACE, MRAI_TIMER_WHEEL
 
 	curRT = None
 	curNB = None
@@ -2021,15 +3278,15 @@ def readConfig(lines):
 				sys.exit(-1)
 		elif cmd[0] == "event":
 			if cmd[1] == "announce-prefix": # event announce-prefix x.x.x.x x.x.x.x sec
-				_event_Scheduler.add(CEvent(toSystemTime(float(cmd[4])), [cmd[2], cmd[3]], EVENT_ANNOUNCE_PREFIX))
+				_event_Scheduler.add(CEvent(toSystemTime(float(cmd[4])), (cmd[2], cmd[3]), EVENT_ANNOUNCE_PREFIX))
 			elif cmd[1] == "withdraw-prefix": # event withdraw-prefix x.x.x.x x.x.x.x sec
-				_event_Scheduler.add(CEvent(toSystemTime(float(cmd[4])), [cmd[2], cmd[3]], EVENT_WITHDRAW_PREFIX))
+				_event_Scheduler.add(CEvent(toSystemTime(float(cmd[4])), (cmd[2], cmd[3]), EVENT_WITHDRAW_PREFIX))
 			elif cmd[1] == "link-down": # event link-down x.x.x.x x.x.x.x sec
-				_event_Scheduler.add(CEvent(toSystemTime(float(cmd[4])), [cmd[2], cmd[3]], EVENT_LINK_DOWN))
+				_event_Scheduler.add(CEvent(toSystemTime(float(cmd[4])), (cmd[2], cmd[3]), EVENT_LINK_DOWN))
 			elif cmd[1] == "link-up": # event link-up x.x.x.x x.x.x.x sec
-				_event_Scheduler.add(CEvent(toSystemTime(float(cmd[4])), [cmd[2], cmd[3]], EVENT_LINK_UP))
+				_event_Scheduler.add(CEvent(toSystemTime(float(cmd[4])), (cmd[2], cmd[3]), EVENT_LINK_UP))
 			elif cmd[1] == "terminate":
-				_event_Scheduler.add(CEvent(toSystemTime(float(cmd[2])), [], EVENT_TERMINATE))
+				_event_Scheduler.add(CEvent(toSystemTime(float(cmd[2])), (), EVENT_TERMINATE))
 			else:
 				print "unknown event", cmd[1], "in", cmd
 				sys.exit(-1)
@@ -2072,18 +3329,55 @@ def readConfig(lines):
 				default_link_delay_func = interpretDelay(cmd[2:])
 			elif cmd[1] == "default-process-delay":
 				default_process_delay_func = interpretDelay(cmd[2:])
+			elif cmd[1] == "coalesce-updates":
+				COALESCE_UPDATES = True
+			elif cmd[1] == "in-flight-supersession":
+				SUPERSEDE_IN_FLIGHT = True
+			elif cmd[1] == "batch-decisions":
+				BATCH_DECISIONS = True
+			elif cmd[1] == "cancel-obsolete-events":
+				CANCEL_OBSOLETE_EVENTS = True
+			elif cmd[1] == "quiescence-detection":
+				QUIESCENCE_DETECTION = True
+			elif cmd[1] == "mrai-timer-wheel":
+				MRAI_TIMER_WHEEL = True
+			elif cmd[1] == "perf-report":
+				PERF_REPORT = cmd[2]
+			elif cmd[1] == "event-trace":
+				EVENT_TRACE = cmd[2]
+			elif cmd[1] == "event-scheduler":
+				if cmd[2] == "list":
+					setEventScheduler(SCHEDULER_LIST)
+				elif cmd[2] == "heap":
+					setEventScheduler(SCHEDULER_HEAP)
+				elif cmd[2] == "calendar": # config event-scheduler calendar [bucket-width-in-sec]
+					if len(cmd) > 3:
+						setEventScheduler(SCHEDULER_CALENDAR, toSystemTime(float(cmd[3])))
+					else:
+						setEventScheduler(SCHEDULER_CALENDAR)
+				else:
+					print "unknown event scheduler", cmd[2], "in", cmd
+					sys.exit(-1)
 			else:
 				print "unknown config option", cmd[1], "in", cmd
 				sys.exit(-1)
 		else:
 			print "unkown command", cmd[0], "in", cmd
 			sys.exit(-1)
+	
+	# The route maps are configured
+	for map in _route_map_list.values():
+		map.compile()
 
 #
 # Initialization of global variables
 #
 def init(output='sim_output'):
-	global _event_Scheduler
+	global _event_Scheduler, EVENT_SCHEDULER, CALENDAR_WIDTH
+	global _cancelled_events
+	global _pending_events, _quiescent, _busy_peer, _unconverged_events, _convergence_log
+	global _perf_count, _perf_time, _perf_peak, _perf_start
+	global _path_attributes
 	global _systime
 	global _router_list
 	global _router_graph #Graph of BGP sessions
@@ -2095,7 +3389,21 @@ def init(output='sim_output'):
 	global bgp_topology
 	global output_file
 	
-	_event_Scheduler = COrderedList()
+	# The scheduler is configured again by each config (config event-scheduler)
+	EVENT_SCHEDULER = SCHEDULER_HEAP
+	CALENDAR_WIDTH = None
+	_event_Scheduler = newEventScheduler(EVENT_SCHEDULER)
+	_cancelled_events = 0
+	_pending_events = defaultdict(int)
+	_quiescent = True
+	_busy_peer = None
+	_unconverged_events = []
+	_convergence_log = []
+	_perf_count = defaultdict(int)
+	_perf_time = defaultdict(float)
+	_perf_peak = defaultdict(int)
+	_perf_start = time.time()
+	_path_attributes = weakref.WeakValueDictionary()
 	_systime = 0	
 	_router_list = {}
 	_router_graph = {}
@@ -2155,23 +3463,101 @@ def output_processing_time(filename, in_cone):
 	output_file.close()
 
 
-def run(pfx_to_mult=None):
-	global _systime, _event_Scheduler, allocated_prefixes, pfx2children_mapping, parentless_prefixes, pfx_to_multiplicator_map, cur_time
+#
+# Compute the DRAGON prefix relationships before running the events
+#
+def prepareRun(pfx_to_mult=None):
+	global allocated_prefixes, pfx2children_mapping, parentless_prefixes, pfx_to_multiplicator_map
 	
 	pfx_to_multiplicator_map = pfx_to_mult
 	
+	# The outbound policies are set, group the peers
+	for router in _router_list.values():
+		router.buildUpdateGroups()
+	
 	if DRAGON_ACTIVATED:
 		pfx2children_mapping = build_pfx2children_mapping(allocated_prefixes.prefixes())
 		parentless_prefixes = return_parentless_prefixes(allocated_prefixes.prefixes())
+
+#
+# Process the scheduled events happening before horizon (all of them if None),
+# and ordered before the (time, sequence number) until if given.
+# Return -1 if the simulation terminated.
+#
+def processEvents(horizon=None, until=None):
+	global _systime, cur_time, _quiescent
 	
 	while len(_event_Scheduler) > 0:
-		cur_event = _event_Scheduler.pop(0)
+		if horizon is not None and _event_Scheduler[0].time >= horizon:
+			return 0
+		if until is not None and (_event_Scheduler[0].time, _event_Scheduler[0].seq) > until:
+			return 0
+		cur_event = popEvent()
+		# Lazy deletion of cancelled events
+		if cur_event.cancelled:
+			continue
+		# Parallel simulation: the event belongs to another partition
+		if _router_partition is not None and not isLocalEvent(cur_event):
+			continue
 		_systime = cur_event.time
 		if (cur_event.type != EVENT_START_TRACK_TIME) and (cur_event.type != EVENT_STOP_TRACK_TIME):
 			cur_time = float(formatTime(_systime))
-		if cur_event.process() == -1:
-			break
+		start = time.time()
+		result = cur_event.process()
+		_perf_time[cur_event.type] += time.time() - start
+		_perf_count[cur_event.type] += 1
+		if _trace_writer is not None and not cur_event.cancelled:
+			_trace_writer.write(cur_event)
+		if result == -1:
+			return -1
+		
+		if QUIESCENCE_DETECTION and _router_partition is None:
+			if cur_event.type in _injected_events:
+				_unconverged_events.append(cur_event)
+				_quiescent = False
+			elif cur_event.type in _message_events:
+				_quiescent = False
+			if not _quiescent and controlPlaneQuiescent():
+				_quiescent = True
+				for event in _unconverged_events:
+					_convergence_log.append((event.type, event.param, event.time, _systime))
+				del _unconverged_events[:]
+				# Only no-op MRAI expiries and terminate events are left
+				pending = len(_event_Scheduler) - _pending_events[EVENT_MRAI_EXPIRE_SENDTO] - _pending_events[EVENT_MRAI_WHEEL] - _pending_events[EVENT_TERMINATE]
+				if pending == 0:
+					return -1 if _pending_events[EVENT_TERMINATE] > 0 else 0
+	return 0
+
+#
+# Pop the next event, keeping track of the number of pending events per type
+#
+def popEvent():
+	event = _event_Scheduler.pop(0)
+	_pending_events[event.type] -= 1
+	return event
+
+#
+# Check that no UPDATE is in flight or waiting to be processed or sent. The
+# pending MRAI expiries then send nothing.
+#
+def controlPlaneQuiescent():
+	global _busy_peer
 	
+	for event_type in _message_events:
+		if _pending_events[event_type] > 0:
+			return False
+	# Start with the last out_queue found not empty
+	if _busy_peer is not None and _busy_peer.out_queue:
+		return False
+	for rt in _router_list.values():
+		for peer in rt.peers.values():
+			if peer.out_queue:
+				_busy_peer = peer
+				return False
+	_busy_peer = None
+	return True
+
+def finishRun():
 	if CHECK_LOOP:
 		nodes = _infect_nodes.keys()
 		for node in nodes:
@@ -2184,6 +3570,1040 @@ def run(pfx_to_mult=None):
 	
 	if SHOW_STATISTICS:
 		output_number_updates(output_file)
+		for (event_type, param, injected, converged) in _convergence_log:
+			print "Convergence of event", _event_names[event_type], array2str(param, " "), "at", formatTime(injected) + ":", formatTime(converged - injected)
+		if COALESCE_UPDATES:
+			print "Decision runs saved by coalescing:", sum([rt.num_coalesced_updates for rt in _router_list.values()])
+		if SUPERSEDE_IN_FLIGHT:
+			print "Superseded in-flight updates:", sum([lk.num_superseded for links in _router_graph.values() for lk in links.values()])
+		if CANCEL_OBSOLETE_EVENTS:
+			print "Cancelled events:", _cancelled_events
+	
+	if PERF_REPORT is not None:
+		writePerfReport(PERF_REPORT)
+
+def run(pfx_to_mult=None):
+	prepareRun(pfx_to_mult)
+	if EVENT_TRACE is not None:
+		startTrace(EVENT_TRACE)
+	processEvents()
+	stopTrace()
+	finishRun()
+
+###################PERFORMANCE COUNTERS##################################
+#
+# Events are counted and timed by type in processEvents, and the peak number
+# of scheduled events of each type is tracked when they are added. Routers
+# count their decision runs and aggregates computations, and time the calls
+# to the aggregates library.
+#
+#########################################################################
+
+#
+# Return the performance counters since init, per event type and per router
+#
+def perfReport():
+	events = {}
+	for event_type in set(_perf_count.keys() + _perf_peak.keys()):
+		events[_event_names[event_type]] = {
+			'count': _perf_count[event_type],
+			'time': _perf_time[event_type],
+			'peak_queue_length': _perf_peak[event_type],
+		}
+	routers = {}
+	for (rid, rt) in _router_list.items():
+		routers[rid] = {
+			'decision_runs': rt.num_decision_runs,
+			'aggregates_computations': rt.num_aggregates_computations,
+			'aggregation_time': rt.aggregation_time,
+			'exports': rt.num_exports,
+		}
+	return {
+		'wall_time': time.time() - _perf_start,
+		'simulated_time': _systime/1000000.0,
+		'events': events,
+		'routers': routers,
+	}
+
+#
+# Return the performance counters of the processed events
+#
+def perfCounters():
+	return (dict(_perf_count), dict(_perf_time), dict(_perf_peak))
+
+#
+# Add the counters of a parallel or sharded worker, counted from the initial
+# counters it was forked with
+#
+def mergePerfCounters(counters, initial):
+	(counts, times, peaks) = counters
+	for (event_type, count) in counts.items():
+		_perf_count[event_type] += count - initial[0].get(event_type, 0)
+	for (event_type, tm) in times.items():
+		_perf_time[event_type] += tm - initial[1].get(event_type, 0)
+	for (event_type, peak) in peaks.items():
+		_perf_peak[event_type] = max(_perf_peak[event_type], peak)
+
+def writePerfReport(filename):
+	report_file = open(filename, 'w')
+	json.dump(perfReport(), report_file, indent=1, sort_keys=True)
+	report_file.close()
+
+###################EVENT TRACES##########################################
+#
+# Binary trace of the processed events. A trace starts with TRACE_MAGIC and
+# is a sequence of records:
+#   'S' <length:H> <bytes>                       define the next string id
+#   'E' <time:d> <seq:q> <type:B> <param value>  processed event
+# Values are tagged: 'N' None, 'i' <q>, 'f' <d>, 's' <string id:I>, 't' and
+# 'l' <length:H> <values> for tuples and lists, 'U' <prefix> <paths list> for
+# a CUpdate and 'P' <attributes tuple> for a CPath. Router ids and prefixes
+# are thus stored once.
+#
+# A trace can be replayed on the same config for some routers or prefixes
+# only. The recorded events drive them in place of the rest of the network,
+# and the events they schedule are dropped.
+#
+#########################################################################
+
+TRACE_MAGIC = 'DRAGONTRACE1'
+
+class CTraceWriter:
+	file = None
+	strings = None # key: string, value: string id
+
+	def __init__(self, filename):
+		self.file = open(filename, 'wb')
+		self.file.write(TRACE_MAGIC)
+		self.strings = {}
+
+	def intern(self, string):
+		sid = self.strings.get(string)
+		if sid is None:
+			sid = len(self.strings)
+			self.strings[string] = sid
+			self.file.write('S' + struct.pack('<H', len(string)) + string)
+		return sid
+
+	def encode(self, value, out):
+		vtype = type(value)
+		if value is None:
+			out.append('N')
+		elif vtype is str:
+			out.append('s' + struct.pack('<I', self.intern(value)))
+		elif vtype is int or vtype is long:
+			out.append('i' + struct.pack('<q', value))
+		elif vtype is float:
+			out.append('f' + struct.pack('<d', value))
+		elif vtype is tuple or vtype is list:
+			out.append(('t' if vtype is tuple else 'l') + struct.pack('<H', len(value)))
+			for item in value:
+				self.encode(item, out)
+		elif isinstance(value, CUpdate):
+			out.append('U')
+			self.encode(value.prefix, out)
+			self.encode(value.paths, out)
+		elif isinstance(value, CPath):
+			out.append('P')
+			self.encode((value.index, value.src_pid, value.weight, value.local_pref, value.med, value.nexthop,\
+				value.igp_cost, value.community, tuple(value.aspath), value.alternative), out)
+		else:
+			print "Unsupported value in event trace", value
+			sys.exit(-1)
+
+	def write(self, event):
+		out = ['E' + struct.pack('<dqB', event.time, event.seq, event.type)]
+		self.encode(event.param, out)
+		self.file.write(''.join(out))
+
+	def close(self):
+		self.file.close()
+
+class CTraceReader:
+	file = None
+	data = None # memory map of the trace
+	offset = 0
+	strings = None # string ids
+
+	def __init__(self, filename):
+		self.file = open(filename, 'rb')
+		self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		if self.data[:len(TRACE_MAGIC)] != TRACE_MAGIC:
+			print "Invalid event trace", filename
+			sys.exit(-1)
+		self.offset = len(TRACE_MAGIC)
+		self.strings = []
+
+	def unpack(self, fmt):
+		values = struct.unpack_from(fmt, self.data, self.offset)
+		self.offset += struct.calcsize(fmt)
+		return values
+
+	def decode(self):
+		tag = self.data[self.offset]
+		self.offset += 1
+		if tag == 'N':
+			return None
+		elif tag == 's':
+			return self.strings[self.unpack('<I')[0]]
+		elif tag == 'i':
+			return self.unpack('<q')[0]
+		elif tag == 'f':
+			return self.unpack('<d')[0]
+		elif tag == 't' or tag == 'l':
+			(length,) = self.unpack('<H')
+			items = [self.decode() for i in range(length)]
+			if tag == 't':
+				return tuple(items)
+			return items
+		elif tag == 'U':
+			update = CUpdate(self.decode())
+			update.paths = self.decode()
+			return update
+		elif tag == 'P':
+			path = CPath()
+			(path.index, path.src_pid, path.weight, path.local_pref, path.med, path.nexthop,\
+				path.igp_cost, path.community, path.aspath, path.alternative) = self.decode()
+			path.aspath = asPath(path.aspath)
+			return internPath(path)
+		print "Corrupted event trace at offset", self.offset - 1
+		sys.exit(-1)
+
+    #
+    # Generate the recorded events, in processing order
+    #
+	def events(self):
+		while self.offset < len(self.data):
+			tag = self.data[self.offset]
+			self.offset += 1
+			if tag == 'S':
+				(length,) = self.unpack('<H')
+				self.strings.append(self.data[self.offset:self.offset + length])
+				self.offset += length
+			elif tag == 'E':
+				event = CEvent.__new__(CEvent)
+				(event.time, event.seq, event.type) = self.unpack('<dqB')
+				event.param = self.decode()
+				event.cancelled = False
+				yield event
+			else:
+				print "Corrupted event trace at offset", self.offset - 1
+				sys.exit(-1)
+
+	def close(self):
+		self.data.close()
+		self.file.close()
+
+def startTrace(filename):
+	global _trace_writer
+	_trace_writer = CTraceWriter(filename)
+
+def stopTrace():
+	global _trace_writer
+	if _trace_writer is not None:
+		_trace_writer.close()
+		_trace_writer = None
+
+#
+# Return the prefix an event is about, or None
+#
+def eventPrefix(event):
+	if event.type == EVENT_RECEIVE:
+		return event.param[2].prefix
+	elif event.type in [EVENT_UPDATE, EVENT_ANNOUNCE_PREFIX, EVENT_WITHDRAW_PREFIX]:
+		return event.param[1]
+	elif event.type == EVENT_MRAI_EXPIRE_SENDTO:
+		return event.param[2]
+	return None
+
+def replayEvent(event):
+	if event.type == EVENT_RECEIVE:
+		(rtid, rvid, update) = event.param
+		if SUPERSEDE_IN_FLIGHT:
+			# Recorded deliveries were not superseded
+			getRouterLink(rtid, rvid).in_flight.pop((rtid, update.prefix), None)
+	elif event.type == EVENT_MRAI_EXPIRE_SENDTO:
+		(sdid, rvid, prefix) = event.param
+		# The expiry scheduled during the replay is the recorded one
+		scheduled = _router_list[sdid].mrai_events.get((rvid, prefix))
+		if scheduled is not None and scheduled.time == event.time:
+			_router_list[sdid].mrai_events[(rvid, prefix)] = event
+	elif event.type == EVENT_MRAI_WHEEL:
+		(rtid,) = event.param
+		_router_list[rtid].mrai_wheel_event = event
+	return event.process()
+
+#
+# Replay a trace on the configured (not yet run) simulator, for the routers
+# and prefixes given (all of them if None). Events about other routers and
+# prefixes are skipped. Return the number of replayed events.
+#
+# The RIBs of the replayed routers and prefixes are the ones of the recorded
+# run. With DRAGON, prefixes must be replayed with their whole family (see
+# prefixFamilies). Prefixes share the per-peer MRAI timers, so the UPDATEs
+# sent for some prefixes only may differ from the recorded run.
+#
+def replayTrace(filename, routers=None, prefixes=None, pfx_to_mult=None):
+	global _systime, cur_time, _router_partition, _local_partition, _outgoing_updates
+	
+	prepareRun(pfx_to_mult)
+	while len(_event_Scheduler) > 0:
+		popEvent()
+	if routers is not None:
+		_router_partition = dict([(rid, 0 if rid in routers else 1) for rid in _router_list])
+		_local_partition = 0
+		_outgoing_updates = []
+	if prefixes is not None:
+		prefixes = set(prefixes)
+	
+	replayed = 0
+	reader = CTraceReader(filename)
+	for event in reader.events():
+		# The output files of the recorded run are not rewritten
+		if event.type in _output_events or not isLocalEvent(event):
+			continue
+		if prefixes is not None:
+			prefix = eventPrefix(event)
+			if prefix is not None and prefix not in prefixes:
+				continue
+		_systime = event.time
+		if (event.type != EVENT_START_TRACK_TIME) and (event.type != EVENT_STOP_TRACK_TIME):
+			cur_time = float(formatTime(_systime))
+		start = time.time()
+		result = replayEvent(event)
+		_perf_time[event.type] += time.time() - start
+		_perf_count[event.type] += 1
+		replayed += 1
+		# Drop the events scheduled by the replayed ones
+		while len(_event_Scheduler) > 0:
+			popEvent()
+		if _outgoing_updates:
+			del _outgoing_updates[:]
+		if result == -1:
+			break
+	reader.close()
+	
+	_router_partition = None
+	_local_partition = None
+	_outgoing_updates = None
+	return replayed
+
+###################PARALLEL SIMULATION###################################
+#
+# Conservative parallel discrete-event simulation. Routers are partitioned
+# across worker processes forked from the configured simulator, and only
+# interact through EVENT_RECEIVE. Workers run synchronous time windows: each
+# window ends one lookahead (the minimum link delay) after the earliest pending
+# event, so no UPDATE sent during a window can be delivered within it. Cross
+# partition UPDATEs are exchanged through pipes between windows.
+#
+#########################################################################
+
+_router_partition = None # key: router id, value: partition
+_local_partition = None
+_outgoing_updates = None # (time, sequence number, sender id, receiver id, update) for other partitions
+
+#
+# Return the lower bound (in seconds) of a delay function
+#
+def delayfuncMin(delayfunc):
+	if delayfunc[0] == "deterministic":
+		return delayfunc[1]
+	elif delayfunc[0] == "uniform": # uniform a b
+		return min(delayfunc[1], delayfunc[2])
+	elif delayfunc[0] == "pareto": # pareto alpha
+		return 1.0
+	else: # normal, exponential and weibull are not bounded away from 0
+		return 0
+
+#
+# Return the lookahead (system time) of the parallel simulation
+#
+def parallelLookahead():
+	delayfuncs = [default_link_delay_func] + _link_delay_table.values()
+	return toSystemTime(min([delayfuncMin(delayfunc) for delayfunc in delayfuncs]))
+
+#
+# Split the routers in num_partitions contiguous blocks of router ids
+#
+def partitionRouters(num_partitions):
+	router_ids = sorted(_router_list.keys(), key=lambda rid: (_router_list[rid].asn, rid))
+	partition = {}
+	for i, rid in enumerate(router_ids):
+		partition[rid] = i*num_partitions/len(router_ids)
+	return partition
+
+def isLocalRouter(rtid):
+	return _router_partition is None or _router_partition[rtid] == _local_partition
+
+#
+# Check if an event is handled by the local partition. Link events are handled
+# on both sides, global events by every partition. The output events need all
+# the routers, they are handled by the coordinator.
+#
+def isLocalEvent(event):
+	if event.type == EVENT_RECEIVE:
+		return isLocalRouter(event.param[1])
+	elif event.type in [EVENT_UPDATE, EVENT_BATCH_UPDATE, EVENT_MRAI_EXPIRE_SENDTO, EVENT_MRAI_WHEEL, EVENT_ANNOUNCE_PREFIX, EVENT_WITHDRAW_PREFIX]:
+		return isLocalRouter(event.param[0])
+	elif event.type in [EVENT_LINK_DOWN, EVENT_LINK_UP]:
+		return isLocalRouter(event.param[0]) or isLocalRouter(event.param[1])
+	elif event.type in _output_events:
+		return _router_partition is None
+	return True
+
+#
+# Return the time of the next local event, or None
+#
+def nextLocalEventTime():
+	while len(_event_Scheduler) > 0:
+		event = _event_Scheduler[0]
+		if not event.cancelled and isLocalEvent(event):
+			return event.time
+		popEvent()
+	return None
+
+#
+# Return the state of a router that is sent back to the coordinator
+#
+def routerState(rt):
+	return {
+		'loc_rib': [(node.prefix, node.data) for node in rt.loc_rib.nodes()],
+		'filtered_prefixes': rt.filtered_prefixes,
+		'aggregated_prefixes': rt.aggregated_prefixes,
+		'aggregate_tree': wrapper.get_tree_pfxes(rt.aggregate_tree),
+		'announced_prefixes': rt.announced_prefixes,
+		'origin_rib': rt.origin_rib,
+		'mrai': rt.mrai,
+		'num_updates': dict(rt.num_updates),
+		'num_coalesced_updates': rt.num_coalesced_updates,
+		'perf': (rt.num_decision_runs, rt.num_aggregates_computations, rt.aggregation_time, rt.num_exports),
+		'next_idle_time': rt.next_idle_time,
+		'peers': dict([(pid, (peer.rib_in, peer.rib_out, peer.out_queue)) for (pid, peer) in rt.peers.items()]),
+		'links': dict([(pid, rt.getPeerLink(pid).status) for pid in rt.peers]),
+	}
+
+def setRouterState(rt, state):
+	rt.loc_rib = radix.Radix()
+	for (prefix, data) in state['loc_rib']:
+		node = rt.loc_rib.add(prefix)
+		node.data.update(data)
+	rt.filtered_prefixes = state['filtered_prefixes']
+	rt.aggregated_prefixes = state['aggregated_prefixes']
+	rt.aggregate_tree = wrapper.aggregate_tree()
+	for (prefix, route_type) in state['aggregate_tree']:
+		wrapper.insert_pfx(rt.aggregate_tree, prefix, route_type)
+	rt.announced_prefixes = state['announced_prefixes']
+	rt.origin_rib = state['origin_rib']
+	rt.mrai = state['mrai']
+	rt.num_updates = defaultdict(int, state['num_updates'])
+	rt.num_coalesced_updates = state['num_coalesced_updates']
+	(rt.num_decision_runs, rt.num_aggregates_computations, rt.aggregation_time, rt.num_exports) = state['perf']
+	rt.next_idle_time = state['next_idle_time']
+	for (pid, (rib_in, rib_out, out_queue)) in state['peers'].items():
+		rt.peers[pid].rib_in = rib_in
+		rt.peers[pid].rib_out = rib_out
+		rt.peers[pid].out_queue = out_queue
+	for (pid, status) in state['links'].items():
+		rt.getPeerLink(pid).status = status
+	rt.adj_rib_in.rebuild()
+
+#
+# Worker process: run the windows requested by the coordinator on the pipe
+#
+def parallelWorker(partition, router_partition, pipe):
+	global _router_partition, _local_partition, _outgoing_updates
+	_router_partition = router_partition
+	_local_partition = partition
+	_outgoing_updates = []
+	
+	pipe.send(nextLocalEventTime())
+	while True:
+		request = pipe.recv()
+		if request[0] == "window":
+			(cmd, horizon, until, updates) = request
+			# The UPDATEs keep their sequence number, to break time ties as the sender did
+			for (tm, seq, sdid, rvid, update) in updates:
+				_event_Scheduler.add(CEvent(tm, (sdid, rvid, update), EVENT_RECEIVE, seq))
+			status = processEvents(horizon, until)
+			pipe.send((status, nextLocalEventTime(), _systime, _outgoing_updates))
+			_outgoing_updates = []
+		elif request[0] == "state":
+			pipe.send((dict([(rid, routerState(rt)) for (rid, rt) in _router_list.items() if isLocalRouter(rid)]), cur_time, start_time))
+		else:
+			pipe.send((dict([(rid, routerState(rt)) for (rid, rt) in _router_list.items() if isLocalRouter(rid)]), perfCounters()))
+			pipe.close()
+			return
+
+#
+# Process an output event in the coordinator of a parallel or sharded run, once
+# the state of the routers is merged
+#
+def processOutputEvent(event):
+	global _systime, cur_time
+	
+	_systime = event.time
+	if event.type != EVENT_STOP_TRACK_TIME:
+		cur_time = float(formatTime(_systime))
+	start = time.time()
+	event.process()
+	_perf_time[event.type] += time.time() - start
+	_perf_count[event.type] += 1
+
+#
+# Run the simulation over num_workers processes. Final RIBs and counters are
+# merged back in _router_list. The windows stop at the output events, which are
+# processed by the coordinator with the router states of the workers.
+#
+def runParallel(num_workers, pfx_to_mult=None):
+	global _systime, cur_time, start_time
+	
+	if SUPERSEDE_IN_FLIGHT or CANCEL_OBSOLETE_EVENTS or CHECK_LOOP:
+		print "in-flight-supersession, cancel-obsolete-events and check-loop are not supported by the parallel simulation"
+		sys.exit(-1)
+	lookahead = parallelLookahead()
+	if lookahead <= 0:
+		print "The parallel simulation needs a link delay distribution with a positive minimum"
+		sys.exit(-1)
+	
+	prepareRun(pfx_to_mult)
+	
+	output_events = [event for event in scheduledEvents() if event.type in _output_events and not event.cancelled]
+	router_partition = partitionRouters(num_workers)
+	initial_perf = perfCounters()
+	pipes = []
+	workers = []
+	for partition in range(num_workers):
+		(pipe, worker_pipe) = multiprocessing.Pipe()
+		worker = multiprocessing.Process(target=parallelWorker, args=(partition, router_partition, worker_pipe))
+		worker.start()
+		pipes.append(pipe)
+		workers.append(worker)
+	
+	def collectRouterStates():
+		global cur_time, start_time
+		for pipe in pipes:
+			pipe.send(("state",))
+		for pipe in pipes:
+			(states, worker_cur_time, start_time) = pipe.recv()
+			cur_time = max(cur_time, worker_cur_time)
+			for (rid, state) in states.items():
+				setRouterState(_router_list[rid], state)
+	
+	next_times = [pipe.recv() for pipe in pipes]
+	pending_updates = [[] for partition in range(num_workers)]
+	terminated = False
+	while True:
+		times = [tm for tm in next_times if tm is not None]
+		for updates in pending_updates:
+			times.extend([update[0] for update in updates])
+		if not times:
+			break
+		horizon = min(times) + lookahead
+		until = None
+		if output_events:
+			until = (output_events[0].time, output_events[0].seq)
+		for partition in range(num_workers):
+			pending_updates[partition].sort(key=lambda update: (update[0], update[1]))
+			pipes[partition].send(("window", horizon, until, pending_updates[partition]))
+		pending_updates = [[] for partition in range(num_workers)]
+		
+		for partition in range(num_workers):
+			(status, next_times[partition], systime, updates) = pipes[partition].recv()
+			_systime = max(_systime, systime)
+			terminated = terminated or status == -1
+			for update in updates:
+				pending_updates[router_partition[update[3]]].append(update)
+		if terminated:
+			break
+		# The events ordered before the output event are processed, and the
+		# UPDATEs sent in the window are received after the horizon
+		if until is not None and until[0] < horizon:
+			collectRouterStates()
+			processOutputEvent(output_events.pop(0))
+	
+	if output_events and not terminated:
+		collectRouterStates()
+		for event in output_events:
+			processOutputEvent(event)
+	
+	for pipe in pipes:
+		pipe.send(("finish",))
+		(states, perf) = pipe.recv()
+		for (rid, state) in states.items():
+			setRouterState(_router_list[rid], state)
+		mergePerfCounters(perf, initial_perf)
+	for worker in workers:
+		worker.join()
+	
+	finishRun()
+
+###################PREFIX SHARDING######################################
+#
+# Prefixes only interact through DRAGON: a prefix with its more-specifics,
+# the aggregates with the prefixes of their sibling half in the aggregate
+# tree, and the prefixes of a same originator. The announcements are split in
+# independent prefix families, each simulated on the whole topology in a
+# process of a pool. Link and global events are replayed in every shard.
+#
+# Routers share the processing queue, MRAI timers and random seeds between
+# prefixes. Sharded runs thus converge to the same RIBs as the sequential
+# run, but the timing and number of UPDATEs of each prefix may differ. The
+# merged MRAI timers keep the latest expiry of the shards.
+#
+# The output events are not run in the shards. They are run once by the
+# coordinator on the final merged state, with the simulation time and update
+# counters reached by the shards when passing them.
+#
+#########################################################################
+
+#
+# Return the scheduled events in processing order
+#
+def scheduledEvents():
+	events = []
+	while len(_event_Scheduler) > 0:
+		events.append(_event_Scheduler.pop(0))
+	for event in events:
+		_event_Scheduler.insert(event)
+	return events
+
+#
+# Return the independent prefix families of the prefixes of origins (key:
+# router id, value: prefixes), by default of the scheduled announcements and
+# withdrawals, as lists of prefixes
+#
+def prefixFamilies(origins=None):
+	if origins is None:
+		origins = defaultdict(set)
+		for event in scheduledEvents():
+			if event.type in [EVENT_ANNOUNCE_PREFIX, EVENT_WITHDRAW_PREFIX]:
+				origins[event.param[0]].add(event.param[1])
+	origins = [set([IPv4Network(pfx) for pfx in prefixes]) for prefixes in origins.values()]
+	prefixes = set()
+	for announced in origins:
+		prefixes.update(announced)
+	
+	# Sorted networks come before their more-specifics
+	families = []
+	for pfx in sorted(prefixes):
+		if families and pfx in families[-1][0]:
+			families[-1].append(pfx)
+		else:
+			families.append([pfx])
+	
+	if DRAGON_ACTIVATED:
+		families = mergeCoupledFamilies(families, origins)
+	return [[str(pfx) for pfx in family] for family in families]
+
+#
+# Merge the families whose DRAGON state is shared:
+# - in the aggregate tree, a parentless prefix is an aggregate depending on
+#   the phi of its parent node, i.e. on the prefixes in its sibling half;
+# - an originator keeps the announced prefixes of all its prefixes in a single
+#   set (announced_prefixes).
+#
+def mergeCoupledFamilies(families, origins):
+	roots = [int(family[0].network) for family in families]
+	group = range(len(families))
+	
+	def find(i):
+		while group[i] != i:
+			group[i] = group[group[i]]
+			i = group[i]
+		return i
+	
+	def family(pfx):
+		return bisect.bisect_right(roots, int(pfx.network)) - 1
+	
+	for (i, fam) in enumerate(families):
+		root = fam[0]
+		if root.prefixlen == 0:
+			continue
+		sibling = [pfx for pfx in root.supernet().subnet() if pfx != root][0]
+		first = bisect.bisect_left(roots, int(sibling.network))
+		last = bisect.bisect_right(roots, int(sibling.broadcast))
+		for j in range(first, last):
+			group[find(j)] = find(i)
+	
+	for prefixes in origins:
+		indexes = [family(pfx) for pfx in prefixes]
+		for j in indexes[1:]:
+			group[find(j)] = find(indexes[0])
+	
+	merged = {}
+	for (i, fam) in enumerate(families):
+		merged.setdefault(find(i), []).extend(fam)
+	return [merged[i] for i in sorted(merged)]
+
+#
+# Split the families in num_shards groups with balanced numbers of prefixes
+#
+def shardFamilies(families, num_shards):
+	shards = [[] for i in range(min(num_shards, len(families)))]
+	for family in sorted(families, key=len, reverse=True):
+		min(shards, key=len).extend(family)
+	return shards
+
+#
+# Pool task: simulate the events of the prefixes of one shard
+#
+def shardWorker(prefixes):
+	prefixes = set(prefixes)
+	events = scheduledEvents()
+	while len(_event_Scheduler) > 0:
+		_event_Scheduler.pop(0)
+	output_events = []
+	for event in events:
+		if event.type in [EVENT_ANNOUNCE_PREFIX, EVENT_WITHDRAW_PREFIX] and event.param[1] not in prefixes:
+			continue
+		if event.type in _output_events:
+			if not event.cancelled:
+				output_events.append(event)
+			continue
+		_event_Scheduler.insert(event)
+	aggregate_trees = dict([(rid, dict(wrapper.get_tree_pfxes(rt.aggregate_tree))) for (rid, rt) in _router_list.items()])
+	initial_updates = dict([(rid, dict(rt.num_updates)) for (rid, rt) in _router_list.items()])
+	
+	# UPDATEs sent by the shard, key: router id, value: {peer id: count}
+	def shardUpdates():
+		return dict([(rid, dict([(pid, count - initial_updates[rid].get(pid, 0)) for (pid, count) in rt.num_updates.items()])) for (rid, rt) in _router_list.items()])
+	
+	# (cur_time, start_time, shard UPDATEs) when passing each output event
+	outputs = []
+	status = 0
+	for event in output_events:
+		if status != -1:
+			status = processEvents(until=(event.time, event.seq))
+		outputs.append((cur_time, start_time, shardUpdates()))
+	if status != -1:
+		processEvents()
+	
+	num_updates = shardUpdates()
+	states = {}
+	for (rid, rt) in _router_list.items():
+		states[rid] = routerState(rt)
+		states[rid]['num_updates'] = num_updates[rid]
+		# Only send the aggregate tree entries changed by the shard (nodes
+		# with children are not listed once withdrawn)
+		tree = dict(states[rid]['aggregate_tree'])
+		states[rid]['aggregate_tree'] = [(prefix, route_type) for (prefix, route_type) in tree.items() if aggregate_trees[rid].get(prefix) != route_type]
+		states[rid]['aggregate_tree'].extend([(prefix, 4) for prefix in aggregate_trees[rid] if prefix not in tree])
+	return (_systime, states, outputs, perfCounters())
+
+#
+# Add the state of a router in a shard to the merged state
+#
+def mergeRouterState(rt, state):
+	for (prefix, data) in state['loc_rib']:
+		node = rt.loc_rib.add(prefix)
+		node.data.update(data)
+	rt.filtered_prefixes.update(state['filtered_prefixes'])
+	rt.aggregated_prefixes.extend([pfx for pfx in state['aggregated_prefixes'] if pfx not in rt.aggregated_prefixes])
+	for (prefix, route_type) in state['aggregate_tree']:
+		wrapper.insert_pfx(rt.aggregate_tree, prefix, route_type)
+	rt.announced_prefixes.update(state['announced_prefixes'])
+	rt.origin_rib.update(state['origin_rib'])
+	for (pid, expiry) in state['mrai'].items():
+		if isinstance(expiry, dict): # prefix-based timers
+			timers = rt.mrai.setdefault(pid, {})
+			for (prefix, prefix_expiry) in expiry.items():
+				timers[prefix] = max(timers.get(prefix, 0), prefix_expiry)
+		else:
+			rt.mrai[pid] = max(rt.mrai.get(pid, 0), expiry)
+	for (pid, num_updates) in state['num_updates'].items():
+		rt.num_updates[pid] += num_updates
+	rt.num_coalesced_updates += state['num_coalesced_updates']
+	rt.num_decision_runs += state['perf'][0]
+	rt.num_aggregates_computations += state['perf'][1]
+	rt.aggregation_time += state['perf'][2]
+	rt.num_exports += state['perf'][3]
+	rt.next_idle_time = max(rt.next_idle_time, state['next_idle_time'])
+	for (pid, (rib_in, rib_out, out_queue)) in state['peers'].items():
+		rt.peers[pid].rib_in.update(rib_in)
+		rt.peers[pid].rib_out.update(rib_out)
+		rt.peers[pid].out_queue.update(out_queue)
+	for (pid, status) in state['links'].items():
+		rt.getPeerLink(pid).status = status
+	rt.adj_rib_in.rebuild()
+
+#
+# Run the simulation with the prefix families split over num_shards tasks of a
+# pool of num_workers processes. Final RIBs and update counters are merged
+# back in _router_list, then the output events are run.
+#
+def runSharded(num_workers, num_shards=None, pfx_to_mult=None):
+	global _systime, cur_time, start_time
+	
+	if DRAGON_ACTIVATED and not RESTRICT_AGGREGATES_TO_PARENTLESS_PREFIXES:
+		print "Prefix sharding requires aggregates restricted to parentless prefixes"
+		sys.exit(-1)
+	if CHECK_LOOP:
+		print "check-loop is not supported by the sharded simulation"
+		sys.exit(-1)
+	if num_shards is None:
+		num_shards = 4*num_workers
+	
+	prepareRun(pfx_to_mult)
+	shards = shardFamilies(prefixFamilies(), num_shards)
+	events = [event for event in scheduledEvents() if not event.cancelled]
+	terminate = [event for event in events if event.type == EVENT_TERMINATE][:1]
+	output_events = [event for event in events if event.type in _output_events]
+	
+	# Each task runs in a process freshly forked from the configured simulator
+	initial_perf = perfCounters()
+	pool = multiprocessing.Pool(num_workers, maxtasksperchild=1)
+	results = pool.map(shardWorker, shards, 1)
+	pool.close()
+	pool.join()
+	
+	initial_updates = dict([(rid, dict(rt.num_updates)) for (rid, rt) in _router_list.items()])
+	for (systime, states, outputs, perf) in results:
+		_systime = max(_systime, systime)
+		for (rid, state) in states.items():
+			mergeRouterState(_router_list[rid], state)
+		mergePerfCounters(perf, initial_perf)
+	
+	last_systime = _systime
+	merged_updates = dict([(rid, rt.num_updates) for (rid, rt) in _router_list.items()])
+	for (i, event) in enumerate(output_events):
+		if terminate and (event.time, event.seq) > (terminate[0].time, terminate[0].seq):
+			break
+		cur_time = max([cur_time] + [result[2][i][0] for result in results])
+		start_time = results[0][2][i][1]
+		# The update counters summed over the shards when passing the event
+		for (rid, rt) in _router_list.items():
+			rt.num_updates = defaultdict(int, initial_updates[rid])
+		for result in results:
+			for (rid, counts) in result[2][i][2].items():
+				for (pid, count) in counts.items():
+					_router_list[rid].num_updates[pid] += count
+		processOutputEvent(event)
+	for (rid, rt) in _router_list.items():
+		rt.num_updates = merged_updates[rid]
+	_systime = max(_systime, last_systime)
+	
+	finishRun()
+
+###################SNAPSHOTS#############################################
+#
+# Checkpoint of the whole simulator state, e.g. after the initial
+# convergence, so that experiments can start from it
+#
+#########################################################################
+
+_snapshot_globals = ['_systime', '_seq_seed', '_cancelled_events', 'cur_time', 'start_time',\
+	'_pending_events', '_quiescent', '_unconverged_events', '_convergence_log',\
+	'_router_list', '_router_graph', '_route_map_list', '_event_Scheduler', '_infect_nodes',\
+	'router2prefix_mapping', 'pfx2children_mapping', 'parentless_prefixes', 'pfx_to_multiplicator_map', 'bgp_topology',\
+	'RANDOMIZED_KEY', 'MRAI_JITTER', 'MAX_PATH_NUMBER', 'wrate', 'always_mrai', 'ssld', 'bgp_always_compare_med',\
+	'default_link_delay_func', 'default_process_delay_func', '_link_delay_table', 'EVENT_SCHEDULER', 'CALENDAR_WIDTH',\
+	'COALESCE_UPDATES', 'SUPERSEDE_IN_FLIGHT', 'BATCH_DECISIONS', 'CANCEL_OBSOLETE_EVENTS', 'QUIESCENCE_DETECTION', 'MRAI_TIMER_WHEEL',\
+	'DRAGON_ACTIVATED', 'DRAGON_FILTERING_MODE', 'RESTRICT_AGGREGATES_TO_PARENTLESS_PREFIXES',\
+	'DISABLE_DEAGGREGATES_ANNOUNCEMENT', 'SKIP_STUB_PROCESSING']
+
+#
+# Write the simulator state in filename. The objects are pickled together, so
+# that the events shared by the scheduler, links and routers stay shared.
+#
+def saveSnapshot(filename):
+	state = dict([(name, globals().get(name)) for name in _snapshot_globals])
+	state['allocated_prefixes'] = allocated_prefixes.prefixes()
+	
+	snapshot = gzip.open(filename, 'wb', 1)
+	snapshot.write(cPickle.dumps(state, cPickle.HIGHEST_PROTOCOL))
+	snapshot.close()
+
+#
+# Replace the simulator state by the one saved in filename
+#
+def loadSnapshot(filename):
+	global allocated_prefixes
+	
+	try:
+		snapshot = gzip.open(filename, 'rb')
+		# Unpickling from the decompressed string avoids many small reads
+		state = cPickle.loads(snapshot.read())
+		snapshot.close()
+	except IOError:
+		print "Could not open snapshot : ", filename
+		sys.exit(-1)
+	
+	allocated_prefixes = radix.Radix()
+	for prefix in state.pop('allocated_prefixes'):
+		allocated_prefixes.add(prefix)
+	globals().update(state)
+
+###################SCENARIO FAN-OUT######################################
+#
+# Simulate many scenarios (e.g. every single link failure) from a converged
+# state. Each scenario runs in a child forked from the converged simulator,
+# which shares its state copy-on-write, and sends back a small result record.
+#
+#########################################################################
+
+_changed_prefixes = None # prefixes with a best path change during a scenario
+
+#
+# Return a scenario for the failure of every link
+#
+def linkFailureScenarios(delay=1.0):
+	scenarios = []
+	for rt1 in sorted(_router_graph.keys()):
+		for rt2 in sorted(_router_graph[rt1].keys()):
+			if _router_graph[rt1][rt2].status == LINK_UP:
+				scenarios.append([(delay, (rt1, rt2), EVENT_LINK_DOWN)])
+	return scenarios
+
+#
+# Run a scenario, a list of (delay in seconds from now, param, event type),
+# and return its result record
+#
+def scenarioWorker(scenario):
+	global _changed_prefixes
+	
+	_changed_prefixes = set()
+	for rt in _router_list.values():
+		rt.num_updates = defaultdict(int)
+	
+	start = None
+	for (delay, param, event_type) in scenario:
+		event = CEvent(_systime + toSystemTime(delay), param, event_type)
+		if start is None or event.time < start:
+			start = event.time
+		_event_Scheduler.add(event)
+	
+	prepareRun(pfx_to_multiplicator_map)
+	processEvents()
+	
+	return {
+		'updates': sum([sum(rt.num_updates.values()) for rt in _router_list.values()]),
+		'convergence_time': float(formatTime(_systime - start)) if start is not None else 0.0,
+		'changed_prefixes': sorted(_changed_prefixes),
+	}
+
+#
+# Run every scenario in a forked child, with at most max_workers children at
+# a time. Return the result records in the order of the scenarios (None if
+# the child failed).
+#
+def runScenarios(scenarios, max_workers):
+	results = [None]*len(scenarios)
+	running = {} # key: pipe, value: (child pid, scenario index, received data)
+	next_scenario = 0
+	
+	sys.stdout.flush()
+	while next_scenario < len(scenarios) or running:
+		while next_scenario < len(scenarios) and len(running) < max_workers:
+			(rfd, wfd) = os.pipe()
+			pid = os.fork()
+			if pid == 0:
+				os.close(rfd)
+				status = 1
+				try:
+					data = cPickle.dumps(scenarioWorker(scenarios[next_scenario]), cPickle.HIGHEST_PROTOCOL)
+					while data:
+						data = data[os.write(wfd, data):]
+					status = 0
+				except:
+					traceback.print_exc()
+				sys.stdout.flush()
+				os._exit(status)
+			os.close(wfd)
+			running[rfd] = (pid, next_scenario, [])
+			next_scenario += 1
+		
+		(ready, _, _) = select.select(running.keys(), [], [])
+		for rfd in ready:
+			(pid, index, data) = running[rfd]
+			chunk = os.read(rfd, 65536)
+			if chunk:
+				data.append(chunk)
+				continue
+			# The child closed its pipe
+			os.close(rfd)
+			del running[rfd]
+			(pid, status) = os.waitpid(pid, 0)
+			if status == 0:
+				results[index] = cPickle.loads("".join(data))
+			else:
+				print "Scenario", index, "failed"
+	
+	return results
+
+###################FAILURE IMPACT########################################
+#
+# On a converged state, the failure of a link only re-runs the decision
+# process of its two routers for the prefixes received on the session
+# (peerDown). Other prefixes can only change through DRAGON, within the
+# prefix families of these prefixes. Failures without impact are reported
+# without being simulated.
+#
+#########################################################################
+
+#
+# Return the prefixes whose best path or filtering state may change when each
+# link fails (key: (rt1, rt2)). With DRAGON, the allocated prefixes of the
+# families of the received prefixes are added; the deaggregates they cover may
+# change too.
+#
+def linkFailureImpact():
+	family_of = {}
+	roots = []
+	if DRAGON_ACTIVATED:
+		families = prefixFamilies(router2prefix_mapping)
+		for family in families:
+			for pfx in family:
+				family_of[pfx] = family
+		# Allocated prefixes not covered by another one, sorted
+		roots = sorted([IPv4Network(pfx) for pfx in family_of if pfx in parentless_prefixes])
+	root_networks = [int(root.network) for root in roots]
+	
+	def expand(prefix):
+		if prefix in family_of:
+			return family_of[prefix]
+		network = IPv4Network(prefix)
+		i = bisect.bisect_right(root_networks, int(network.network)) - 1
+		if i >= 0 and network in roots[i]:
+			return family_of[str(roots[i])] + [prefix]
+		return [prefix]
+	
+	impact = {}
+	for rt1 in _router_graph:
+		for rt2 in _router_graph[rt1]:
+			if _router_graph[rt1][rt2].status != LINK_UP:
+				continue
+			received = set(_router_list[rt1].peers[rt2].rib_in.keys()) | set(_router_list[rt2].peers[rt1].rib_in.keys())
+			prefixes = set()
+			for prefix in received:
+				if prefix not in prefixes:
+					prefixes.update(expand(prefix))
+			impact[(rt1, rt2)] = prefixes
+	return impact
+
+#
+# Simulate the failure of every link of a converged simulation with
+# runScenarios, except for the links without impact. Return the result record
+# of every link (key: (rt1, rt2)), with its impact.
+#
+def runLinkFailures(max_workers, delay=1.0):
+	if not controlPlaneQuiescent():
+		print "runLinkFailures needs a converged simulation"
+		sys.exit(-1)
+	
+	impact = linkFailureImpact()
+	links = sorted([link for link in impact if impact[link]])
+	results = runScenarios([[(delay, link, EVENT_LINK_DOWN)] for link in links], max_workers)
+	
+	records = {}
+	for (link, record) in zip(links, results):
+		records[link] = record
+	for link in impact:
+		if not impact[link]:
+			records[link] = {'updates': 0, 'convergence_time': 0.0, 'changed_prefixes': []}
+		if records[link] is not None:
+			records[link]['impact'] = sorted(impact[link])
+	return records
 
 #
 # Launch simulation from string config
@@ -2201,6 +4621,188 @@ def runConfigFile(filename):
 	readConfigFile(filename)
 	run()
 
+###################MONTE CARLO SWEEP#####################################
+#
+# Run a config for several randomize keys and parameter overrides. The config
+# is parsed once; each run is a pool task forked from the parsed simulator.
+# Per-run results are streamed, and their statistics computed online.
+#
+#########################################################################
+
+#
+# Estimation of the p-quantile of a stream in constant memory. The first
+# max_samples values are kept to compute the exact quantile, then the P-square
+# markers (Jain and Chlamtac) are started from them.
+#
+class CQuantileEstimator:
+	p = None
+	samples = None # sorted values, before the markers are started
+	max_samples = None
+	heights = None # marker heights
+	positions = None # marker positions
+	desired = None # desired marker positions
+	increments = None
+
+	def __init__(self, p, max_samples=100):
+		self.p = p
+		self.samples = []
+		self.max_samples = max(max_samples, 5)
+		self.increments = [0, p/2, p, (1 + p)/2, 1]
+
+	def startMarkers(self):
+		q = self.samples
+		last = len(q) - 1
+		self.desired = [0, last*self.p/2, last*self.p, last*(1 + self.p)/2, last]
+		self.positions = [int(round(d)) for d in self.desired]
+		for i in range(1, 4):
+			self.positions[i] = min(max(self.positions[i], self.positions[i - 1] + 1), last - 4 + i)
+		self.heights = [q[i] for i in self.positions]
+		self.samples = None
+
+	def add(self, x):
+		if self.samples is not None:
+			bisect.insort(self.samples, x)
+			if len(self.samples) > self.max_samples:
+				self.startMarkers()
+			return
+		q = self.heights
+		n = self.positions
+		if x < q[0]:
+			q[0] = x
+			k = 0
+		elif x >= q[4]:
+			q[4] = x
+			k = 3
+		else:
+			k = bisect.bisect_right(q, x) - 1
+		for i in range(k + 1, 5):
+			n[i] += 1
+		for i in range(5):
+			self.desired[i] += self.increments[i]
+		# Adjust the heights of the middle markers
+		for i in range(1, 4):
+			d = self.desired[i] - n[i]
+			if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+				d = 1 if d > 0 else -1
+				qp = q[i] + float(d)/(n[i + 1] - n[i - 1])*((n[i] - n[i - 1] + d)*(q[i + 1] - q[i])/(n[i + 1] - n[i]) + (n[i + 1] - n[i] - d)*(q[i] - q[i - 1])/(n[i] - n[i - 1]))
+				if not q[i - 1] < qp < q[i + 1]:
+					qp = q[i] + float(d)*(q[i + d] - q[i])/(n[i + d] - n[i])
+				q[i] = qp
+				n[i] += d
+
+	def value(self):
+		if self.samples is None:
+			return self.heights[2]
+		q = self.samples
+		if not q:
+			return None
+		pos = self.p*(len(q) - 1)
+		i = int(pos)
+		if i + 1 < len(q):
+			return q[i] + (pos - i)*(q[i + 1] - q[i])
+		return q[i]
+
+#
+# Online count, mean, variance (Welford) and quantiles of a stream
+#
+class CRunningStat:
+	count = 0
+	mean = 0
+	m2 = 0
+	quantiles = None
+
+	def __init__(self, quantiles=[0.5, 0.9, 0.99]):
+		self.count = 0
+		self.mean = 0.0
+		self.m2 = 0.0
+		self.quantiles = [CQuantileEstimator(p) for p in quantiles]
+
+	def add(self, x):
+		self.count += 1
+		delta = x - self.mean
+		self.mean += delta/self.count
+		self.m2 += delta*(x - self.mean)
+		for quantile in self.quantiles:
+			quantile.add(x)
+
+	def variance(self):
+		if self.count < 2:
+			return 0.0
+		return self.m2/(self.count - 1)
+
+	def __str__(self):
+		return "%d %.6f %.6f %s" % (self.count, self.mean, self.variance(), " ".join(["%.6f" % quantile.value() for quantile in self.quantiles]))
+
+#
+# Pool task: run the parsed config with a randomize key and an override config
+# (given with its index)
+#
+def sweepWorker(task):
+	global RANDOMIZED_KEY
+	(key, index, override) = task
+	
+	RANDOMIZED_KEY = key
+	if override is not None:
+		loadConfig(override)
+	# The random generators were seeded with the key of the parsed config
+	for rt in _router_list.values():
+		rt.rand_seed = random.Random(str(rt) + RANDOMIZED_KEY)
+		for peer in rt.peers.values():
+			peer.rand_seed = None
+	
+	start = time.time()
+	prepareRun()
+	processEvents()
+	
+	updates = dict([(rt.id, sum(rt.num_updates.values())) for rt in _router_list.values()])
+	return (key, index, updates, float(formatTime(_systime)), time.time() - start)
+
+#
+# Run the config of filename for every key and override (a config string or
+# None). Per-run results are streamed in output.sweep, and the statistics over
+# the runs of each override are returned (a list, in the order of overrides) and
+# appended to it. Overrides are identified by their index, they may be repeated.
+#
+def runSweep(filename, keys, overrides=[None], num_workers=None, output=None, quantiles=[0.5, 0.9, 0.99]):
+	init()
+	readConfigFile(filename)
+	
+	stats = []
+	for override in overrides:
+		stats.append({'updates': CRunningStat(quantiles), 'convergence-time': CRunningStat(quantiles), 'run-time': CRunningStat(quantiles), 'router-updates': {}})
+	
+	sweep_file = None
+	if output is not None:
+		sweep_file = open(output + '.sweep', 'w')
+	
+	tasks = [(key, index, override) for (index, override) in enumerate(overrides) for key in keys]
+	pool = multiprocessing.Pool(num_workers, maxtasksperchild=1)
+	for (key, index, updates, convergence_time, run_time) in pool.imap(sweepWorker, tasks):
+		stat = stats[index]
+		stat['updates'].add(sum(updates.values()))
+		stat['convergence-time'].add(convergence_time)
+		stat['run-time'].add(run_time)
+		for (rid, num_updates) in updates.items():
+			if rid not in stat['router-updates']:
+				stat['router-updates'][rid] = CRunningStat(quantiles)
+			stat['router-updates'][rid].add(num_updates)
+		if sweep_file is not None:
+			sweep_file.write("run %s %d %d %.6f %.3f\n" % (key, index, sum(updates.values()), convergence_time, run_time))
+			sweep_file.flush()
+	pool.close()
+	pool.join()
+	
+	if sweep_file is not None:
+		# stat override-index metric count mean variance quantiles
+		for index in range(len(overrides)):
+			for metric in ['updates', 'convergence-time', 'run-time']:
+				sweep_file.write("stat %d %s %s\n" % (index, metric, stats[index][metric]))
+			for (rid, stat) in sorted(stats[index]['router-updates'].items()):
+				sweep_file.write("stat %d router-updates-%s %s\n" % (index, rid, stat))
+		sweep_file.close()
+	
+	return stats
+
 if __name__ == "__main__":
 	if len(sys.argv) < 2:
 		print "Usage: %s [config_file]" % (sys.argv[0])
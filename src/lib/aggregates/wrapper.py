@@ -78,6 +78,19 @@ def delete_pfx(root, pfx):
 	pfx.contents.route_type = 4
 	pfx.contents.phi = 4
 
+# (prefix, route type) of the routes and leaves of the tree, to rebuild it with insert_pfx
+def get_tree_pfxes(root):
+	pfxes = []
+	stack = [root]
+	while stack:
+		pfx = stack.pop().contents
+		children = [child for child in pfx.children if child]
+		if pfx.route_type != 4 or not children:
+			ip = pfx.prefix & 0xffffffff
+			pfxes.append(("%d.%d.%d.%d/%d" % (ip >> 24, (ip >> 16) & 0xff, (ip >> 8) & 0xff, ip & 0xff, pfx.mask), pfx.route_type))
+		stack.extend(children)
+	return pfxes
+
 def get_aggregates_pfxes(root):
 	node = compute_aggregates_list(root)
 	lst = []
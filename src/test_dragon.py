@@ -3,6 +3,11 @@ import unittest
 import bgp_sim
 import itertools
 import random
+import os
+import tempfile
+import bz2
+import json
+import cPickle
 import networkx as nx
 from utils import output_configuration, compute_aggregate
 
@@ -25,9 +30,41 @@ active_tests = {
 	'testConvergenceEvent' : True,
 	'testMultipleLevelForwardingConsistency' : True,
 	'testAnycastAnnouncementOfAggregate' : True,
-	'testAggregatesComputation' : False
+	'testAggregatesComputation' : False,
+	'testEventSchedulers' : True,
+	'testCoalescedUpdates' : True,
+	'testInFlightSupersession' : True,
+	'testBatchDecisions' : True,
+	'testCancelledEvents' : True,
+	'testParallelSimulation' : True,
+	'testShardedSimulation' : True,
+	'testSweep' : True,
+	'testSnapshot' : True,
+	'testScenarioFanOut' : True,
+	'testLinkFailureImpact' : True,
+	'testQuiescence' : True,
+	'testPerfCounters' : True,
+	'testEventTrace' : True,
+	'testIncrementalSelection' : True,
+	'testRankingKeys' : True,
+	'testPathInterning' : True,
+	'testASPathTrie' : True,
+	'testUpdateGroups' : True,
+	'testOutQueue' : True,
+	'testMRAITimerWheel' : True,
+	'testRouteMapCompilation' : True
 }
 
+def rib_snapshot(prefixes):
+	"""Return the type, best AS path and filtering state of prefixes on every router"""
+	rib = {}
+	for router_id in bgp_sim._router_list:
+		router = bgp_sim._router_list[router_id]
+		for pfx in prefixes:
+			node = router.loc_rib.search_exact(pfx)
+			rib[(router_id, pfx)] = (node.data['type'], node.data['best_path'].aspath, pfx in router.filtered_prefixes) if node else None
+	return rib
+
 class DragonTest(unittest.TestCase):
 	
 	def setUp(self):
@@ -1134,6 +1171,990 @@ class DragonTest(unittest.TestCase):
 			(announce2children, announce2peer_prov) = compute_aggregate(parent, reachable_children_with_types)
 			self.assertEquals(announce2children, sorted(['10.0.8.0/21', '10.0.4.0/22', '10.0.2.0/23']))
 			self.assertEquals(sorted(announce2peer_prov), sorted(['10.0.8.0/21', '10.0.4.0/22', '10.0.2.0/23']))
+	
+	def testEventSchedulers(self):
+		
+		if active_tests['testEventSchedulers']:
+			
+			print "Running testEventSchedulers ..."
+			
+			rand_seed = random.Random("testEventSchedulers")
+			times = [bgp_sim.toSystemTime(rand_seed.choice([0.1, 0.2, 0.25, 1.0])) for i in range(200)]
+			
+			orders = []
+			for (kind, width) in [(bgp_sim.SCHEDULER_LIST, None), (bgp_sim.SCHEDULER_HEAP, None),\
+				 (bgp_sim.SCHEDULER_CALENDAR, None), (bgp_sim.SCHEDULER_CALENDAR, bgp_sim.toSystemTime(0.01))]:
+				bgp_sim.init()
+				bgp_sim.setEventScheduler(kind, width)
+				for tm in times:
+					bgp_sim._event_Scheduler.add(bgp_sim.CEvent(tm, [], bgp_sim.EVENT_RESET_COUNTERS))
+				order = []
+				while len(bgp_sim._event_Scheduler) > 0:
+					order.append(bgp_sim._event_Scheduler.pop(0))
+				orders.append([(event.time, event.seq) for event in order])
+				
+				# Events are ordered by time, then by sequence number
+				self.assertEquals(orders[-1], sorted(orders[-1]))
+			
+			for order in orders[1:]:
+				self.assertEquals([tm for (tm, seq) in orders[0]], [tm for (tm, seq) in order])
+			
+			# init goes back to the default scheduler
+			bgp_sim.loadConfig('config event-scheduler calendar 0.005')
+			bgp_sim.init()
+			self.assertEquals(bgp_sim.EVENT_SCHEDULER, bgp_sim.SCHEDULER_HEAP)
+			self.assertEquals(bgp_sim.CALENDAR_WIDTH, None)
+			self.assertTrue(isinstance(bgp_sim._event_Scheduler, bgp_sim.CEventHeap))
+			
+	def testCoalescedUpdates(self):
+		
+		if active_tests['testCoalescedUpdates']:
+			
+			print "Running testCoalescedUpdates ..."
+			
+			parent = '1.0.0.0/22'
+			child = '1.0.0.0/24'
+			
+			ribs = []
+			for coalesce in [False, True]:
+				bgp_sim.init()
+				bgp_sim.DRAGON_FILTERING_MODE = bgp_sim.DRAGON_ROUTE_CONSISTENCY
+				bgp_sim.readConfigFile(config_dir + "dragon_fig2.cfg")
+				# Slow routers: several UPDATEs for a prefix wait for the same decision run
+				bgp_sim.loadConfig("config default-process-delay uniform 0.2 0.5")
+				bgp_sim.COALESCE_UPDATES = coalesce
+				
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['7.1', parent], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['9.1', child], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				
+				bgp_sim.run()
+				
+				ribs.append(rib_snapshot([parent, child]))
+				
+				num_coalesced_updates = sum([router.num_coalesced_updates for router in bgp_sim._router_list.values()])
+				if coalesce:
+					self.assertTrue(num_coalesced_updates > 0)
+				else:
+					self.assertEquals(num_coalesced_updates, 0)
+			
+			bgp_sim.COALESCE_UPDATES = False
+			bgp_sim.default_process_delay_func = ["uniform", 0.001, 0.01]
+			
+			# Coalescing does not change the converged state
+			self.assertEquals(ribs[0], ribs[1])
+			
+	def testInFlightSupersession(self):
+		
+		if active_tests['testInFlightSupersession']:
+			
+			print "Running testInFlightSupersession ..."
+			
+			parent = '1.0.0.0/22'
+			child = '1.0.0.0/24'
+			
+			ribs = []
+			for supersede in [False, True]:
+				bgp_sim.init()
+				bgp_sim.DRAGON_FILTERING_MODE = bgp_sim.DRAGON_ROUTE_CONSISTENCY
+				bgp_sim.readConfigFile(config_dir + "dragon_fig2.cfg")
+				# Slow links: several UPDATEs for a prefix are in flight on the same link
+				bgp_sim.loadConfig("config default-link-delay uniform 0.5 2")
+				bgp_sim.SUPERSEDE_IN_FLIGHT = supersede
+				
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['7.1', parent], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['9.1', child], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				
+				bgp_sim.run()
+				
+				ribs.append(rib_snapshot([parent, child]))
+				
+				num_superseded = sum([lk.num_superseded for links in bgp_sim._router_graph.values() for lk in links.values()])
+				if supersede:
+					self.assertTrue(num_superseded > 0)
+				else:
+					self.assertEquals(num_superseded, 0)
+			
+			bgp_sim.SUPERSEDE_IN_FLIGHT = False
+			bgp_sim.default_link_delay_func = ["uniform", 0.01, 0.1]
+			
+			# Superseding in-flight updates does not change the converged state
+			self.assertEquals(ribs[0], ribs[1])
+			
+	def testBatchDecisions(self):
+		
+		if active_tests['testBatchDecisions']:
+			
+			print "Running testBatchDecisions ..."
+			
+			grand_parent = '10.0.0.0/16'
+			parent = '10.0.0.0/22'
+			child1 = '10.0.0.0/24'
+			child2 = '10.0.1.0/24'
+			
+			ribs = []
+			computations = []
+			for batch in [False, True]:
+				bgp_sim.init()
+				bgp_sim.DRAGON_FILTERING_MODE = bgp_sim.DRAGON_ROUTE_CONSISTENCY
+				bgp_sim.readConfigFile(config_dir + "dragon_fig2.cfg")
+				# Slow routers: UPDATEs for several prefixes fall in the same processing window
+				bgp_sim.loadConfig("config default-process-delay uniform 0.2 0.5")
+				bgp_sim.BATCH_DECISIONS = batch
+				
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['7.1', grand_parent], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['7.1', parent], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['9.1', child1], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['9.1', child2], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				
+				bgp_sim.run()
+				
+				ribs.append(rib_snapshot([grand_parent, parent, child1, child2]))
+				computations.append(sum([rt.num_aggregates_computations for rt in bgp_sim._router_list.values()]))
+			
+			bgp_sim.BATCH_DECISIONS = False
+			bgp_sim.default_process_delay_func = ["uniform", 0.001, 0.01]
+			
+			# Batching the decision process does not change the converged state
+			self.assertEquals(ribs[0], ribs[1])
+			# and computes the aggregates once per batch
+			self.assertTrue(computations[1] < computations[0])
+			
+	def testCancelledEvents(self):
+		
+		if active_tests['testCancelledEvents']:
+			
+			print "Running testCancelledEvents ..."
+			
+			parent = '1.0.0.0/22'
+			child = '1.0.0.0/24'
+			
+			ribs = []
+			for cancel in [False, True]:
+				bgp_sim.init()
+				bgp_sim.DRAGON_FILTERING_MODE = bgp_sim.DRAGON_ROUTE_CONSISTENCY
+				bgp_sim.readConfigFile(config_dir + "dragon_fig2.cfg")
+				# Slow links: the link fails while UPDATEs are in flight
+				bgp_sim.loadConfig("config default-link-delay uniform 0.5 2")
+				bgp_sim.CANCEL_OBSOLETE_EVENTS = cancel
+				
+				# A cancelled event is never processed
+				terminate = bgp_sim.CEvent(bgp_sim.toSystemTime(0.5), [], bgp_sim.EVENT_TERMINATE)
+				bgp_sim._event_Scheduler.add(terminate)
+				terminate.cancel()
+				
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['7.1', parent], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(2.0), ['9.1', child], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(2.5), ['7.1', '4.1'], bgp_sim.EVENT_LINK_DOWN))
+				
+				bgp_sim.run()
+				
+				ribs.append(rib_snapshot([parent, child]))
+				
+				if cancel:
+					self.assertTrue(bgp_sim._cancelled_events > 1)
+				else:
+					self.assertEquals(bgp_sim._cancelled_events, 1)
+			
+			bgp_sim.CANCEL_OBSOLETE_EVENTS = False
+			bgp_sim.default_link_delay_func = ["uniform", 0.01, 0.1]
+			
+			self.assertTrue(ribs[0][('7.1', parent)] is not None)
+			# Cancelling the obsolete events does not change the converged state
+			self.assertEquals(ribs[0], ribs[1])
+			
+	def testParallelSimulation(self):
+		
+		if active_tests['testParallelSimulation']:
+			
+			print "Running testParallelSimulation ..."
+			
+			parent = '1.0.0.0/22'
+			child = '1.0.0.0/24'
+			
+			ribs = []
+			updates = []
+			outputs = []
+			for workers in [None, 2, 3]:
+				bgp_sim.init()
+				bgp_sim.DRAGON_FILTERING_MODE = bgp_sim.DRAGON_ROUTE_CONSISTENCY
+				bgp_sim.readConfigFile(config_dir + "dragon_fig2.cfg")
+				
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['7.1', parent], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(2.0), ['9.1', child], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(3.0), ['7.1', '4.1'], bgp_sim.EVENT_LINK_DOWN))
+				# The update counts in the middle of the convergence and at the end
+				files = []
+				for tm in [2.05, 50.0]:
+					(fd, output) = tempfile.mkstemp()
+					os.close(fd)
+					os.remove(output)
+					files.append(output + ('.dragon.update.bz2' if bgp_sim.DRAGON_ACTIVATED else '.bgp.update.bz2'))
+					bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(tm), [output], bgp_sim.EVENT_OUTPUT_UPDATES))
+				
+				if workers is None:
+					bgp_sim.run()
+				else:
+					bgp_sim.runParallel(workers)
+				
+				ribs.append(rib_snapshot([parent, child]))
+				updates.append(dict([(rid, dict(rt.num_updates)) for (rid, rt) in bgp_sim._router_list.items()]))
+				outputs.append([])
+				for output in files:
+					outputs[-1].append(sorted(bz2.BZ2File(output).readlines()))
+					os.remove(output)
+			
+			self.assertTrue(ribs[0][('7.1', parent)] is not None)
+			self.assertNotEquals(outputs[0][0], outputs[0][1])
+			# Partitioning the routers does not change the simulation
+			for i in [1, 2]:
+				self.assertEquals(ribs[0], ribs[i])
+				self.assertEquals(updates[0], updates[i])
+				self.assertEquals(outputs[0], outputs[i])
+			
+			# With deterministic delays, UPDATEs received from other workers
+			# tie with local events and keep the sequential order
+			delay_funcs = (bgp_sim.default_link_delay_func, bgp_sim.default_process_delay_func)
+			updates = []
+			for workers in [None, 2, 3, 4, 9]:
+				bgp_sim.init()
+				bgp_sim.DRAGON_FILTERING_MODE = bgp_sim.DRAGON_ROUTE_CONSISTENCY
+				bgp_sim.readConfigFile(config_dir + "dragon_fig2.cfg")
+				bgp_sim.readConfig(["config default-link-delay deterministic 0.05", "config default-process-delay deterministic 0.005"])
+				
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['7.1', parent], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(2.0), ['9.1', child], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(3.0), ['7.1', '4.1'], bgp_sim.EVENT_LINK_DOWN))
+				
+				if workers is None:
+					bgp_sim.run()
+				else:
+					bgp_sim.runParallel(workers)
+				updates.append(dict([(rid, dict(rt.num_updates)) for (rid, rt) in bgp_sim._router_list.items()]))
+			(bgp_sim.default_link_delay_func, bgp_sim.default_process_delay_func) = delay_funcs
+			
+			for i in range(1, len(updates)):
+				self.assertEquals(updates[0], updates[i])
+			
+	def testShardedSimulation(self):
+		
+		if active_tests['testShardedSimulation']:
+			
+			print "Running testShardedSimulation ..."
+			
+			prefixes = ['1.0.0.0/22', '1.0.0.0/24', '2.0.0.0/22', '2.0.1.0/24']
+			
+			ribs = []
+			trees = []
+			timers = []
+			outputs = []
+			for sharded in [False, True]:
+				bgp_sim.init()
+				bgp_sim.DRAGON_FILTERING_MODE = bgp_sim.DRAGON_ROUTE_CONSISTENCY
+				bgp_sim.readConfigFile(config_dir + "dragon_fig2.cfg")
+				
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['7.1', '1.0.0.0/22'], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(2.0), ['9.1', '1.0.0.0/24'], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['8.1', '2.0.0.0/22'], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(2.0), ['4.1', '2.0.1.0/24'], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(3.0), ['7.1', '4.1'], bgp_sim.EVENT_LINK_DOWN))
+				(fd, output) = tempfile.mkstemp()
+				os.close(fd)
+				os.remove(output)
+				(fd, middle) = tempfile.mkstemp()
+				os.close(fd)
+				os.remove(middle)
+				suffix = '.dragon' if bgp_sim.DRAGON_ACTIVATED else '.bgp'
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(0.5), [], bgp_sim.EVENT_START_TRACK_TIME))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(2.05), [middle], bgp_sim.EVENT_OUTPUT_UPDATES))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(50.0), [output], bgp_sim.EVENT_OUTPUT_UPDATES))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(50.0), [output, 1], bgp_sim.EVENT_STOP_TRACK_TIME))
+				
+				if sharded:
+					self.assertEquals(bgp_sim.prefixFamilies(), [['1.0.0.0/22', '1.0.0.0/24'], ['2.0.0.0/22', '2.0.1.0/24']])
+					bgp_sim.runSharded(2)
+				else:
+					bgp_sim.run()
+				
+				ribs.append(rib_snapshot(prefixes))
+				trees.append(dict([(rid, sorted(bgp_sim.routerState(rt)['aggregate_tree'])) for (rid, rt) in bgp_sim._router_list.items()]))
+				timers.append(dict([(rid, rt.mrai) for (rid, rt) in bgp_sim._router_list.items()]))
+				outputs.append((sorted(bz2.BZ2File(output + suffix + '.update.bz2').readlines()), open(output + suffix + '.time').readlines(),\
+					sorted(bz2.BZ2File(middle + suffix + '.update.bz2').readlines())))
+				os.remove(output + suffix + '.update.bz2')
+				os.remove(output + suffix + '.time')
+				os.remove(middle + suffix + '.update.bz2')
+			
+			self.assertTrue(ribs[0][('1.1', '2.0.0.0/22')] is not None)
+			# Families are simulated independently to the same converged state
+			self.assertEquals(ribs[0], ribs[1])
+			self.assertTrue(('2.0.0.0/22', 3) in trees[0]['4.1'])
+			self.assertEquals(trees[0], trees[1])
+			self.assertEquals(timers[0], timers[1])
+			# The output events run once, on the merged counters
+			self.assertEquals(len(outputs[1][1]), 1)
+			self.assertEquals(outputs[0][1], outputs[1][1])
+			num_updates = ["%s %s %d\n" % (rt.id, pid, count) for rt in bgp_sim._router_list.values() for (pid, count) in rt.num_updates.items()]
+			self.assertEquals(outputs[1][0], sorted(num_updates))
+			# A mid-run output has the counters of that time
+			self.assertNotEquals(outputs[1][2], outputs[1][0])
+			
+			# Without DRAGON, the families do not share state and the update
+			# counts are the ones of the sequential run, mid-run included
+			bgp_sim.DRAGON_ACTIVATED = False
+			outputs = []
+			for sharded in [False, True]:
+				bgp_sim.init()
+				bgp_sim.readConfigFile(config_dir + "dragon_fig2.cfg")
+				
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['7.1', '1.0.0.0/22'], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(2.0), ['9.1', '1.0.0.0/24'], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['8.1', '2.0.0.0/22'], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(2.0), ['4.1', '2.0.1.0/24'], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(3.0), ['7.1', '4.1'], bgp_sim.EVENT_LINK_DOWN))
+				files = []
+				for tm in [2.05, 50.0]:
+					(fd, output) = tempfile.mkstemp()
+					os.close(fd)
+					os.remove(output)
+					files.append(output + '.bgp.update.bz2')
+					bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(tm), [output], bgp_sim.EVENT_OUTPUT_UPDATES))
+				
+				if sharded:
+					bgp_sim.runSharded(2)
+				else:
+					bgp_sim.run()
+				
+				outputs.append([])
+				for output in files:
+					outputs[-1].append(sorted(bz2.BZ2File(output).readlines()))
+					os.remove(output)
+			
+			self.assertNotEquals(outputs[0][0], outputs[0][1])
+			self.assertEquals(outputs[0], outputs[1])
+			
+	def testSweep(self):
+		
+		if active_tests['testSweep']:
+			
+			print "Running testSweep ..."
+			
+			stat = bgp_sim.CRunningStat([0.5])
+			for x in [4, 1, 3, 2, 5]:
+				stat.add(x)
+			self.assertEquals((stat.count, stat.mean, stat.variance(), stat.quantiles[0].value()), (5, 3.0, 2.5, 3))
+			
+			announcements = "event announce-prefix 7.1 1.0.0.0/22 1\nevent announce-prefix 9.1 1.0.0.0/24 2"
+			slow_links = announcements + "\nconfig default-link-delay uniform 0.5 2"
+			
+			bgp_sim.DRAGON_FILTERING_MODE = bgp_sim.DRAGON_ROUTE_CONSISTENCY
+			(fd, output) = tempfile.mkstemp()
+			os.close(fd)
+			# A repeated override has its own runs and statistics
+			stats = bgp_sim.runSweep(config_dir + "dragon_fig2.cfg", ['a', 'b', 'c'], [announcements, slow_links, announcements], 2, output)
+			runs = [line.split() for line in open(output + '.sweep') if line.startswith("run ")]
+			os.remove(output)
+			os.remove(output + '.sweep')
+			
+			# The parent keeps the parsed config
+			self.assertEquals(bgp_sim.default_link_delay_func, ["uniform", 0.01, 0.1])
+			self.assertEquals(len(stats), 3)
+			for index in range(3):
+				self.assertEquals(stats[index]['updates'].count, 3)
+				self.assertTrue(stats[index]['updates'].mean > 0)
+				self.assertEquals(len(stats[index]['router-updates']), 9)
+				self.assertEquals(len([run for run in runs if run[2] == str(index)]), 3)
+			self.assertTrue(stats[1]['convergence-time'].mean > stats[0]['convergence-time'].mean)
+			self.assertEquals(stats[0]['updates'].mean, stats[2]['updates'].mean)
+			
+	def testSnapshot(self):
+		
+		if active_tests['testSnapshot']:
+			
+			print "Running testSnapshot ..."
+			
+			parent = '1.0.0.0/22'
+			child = '1.0.0.0/24'
+			(fd, snapshot) = tempfile.mkstemp()
+			os.close(fd)
+			
+			bgp_sim.init()
+			bgp_sim.DRAGON_FILTERING_MODE = bgp_sim.DRAGON_ROUTE_CONSISTENCY
+			bgp_sim.readConfigFile(config_dir + "dragon_fig2.cfg")
+			bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['7.1', parent], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+			bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(2.0), ['9.1', child], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+			bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(3.0), ['7.1', '4.1'], bgp_sim.EVENT_LINK_DOWN))
+			
+			# Checkpoint before the failure, with events pending
+			bgp_sim.prepareRun()
+			bgp_sim.processEvents(bgp_sim.toSystemTime(2.5))
+			bgp_sim.saveSnapshot(snapshot)
+			
+			ribs = []
+			updates = []
+			for restore in [False, True]:
+				if restore:
+					bgp_sim.init()
+					bgp_sim.loadSnapshot(snapshot)
+				bgp_sim.processEvents()
+				ribs.append(rib_snapshot([parent, child]))
+				updates.append(dict([(rid, dict(rt.num_updates)) for (rid, rt) in bgp_sim._router_list.items()]))
+			os.remove(snapshot)
+			
+			self.assertTrue(ribs[0][('4.1', parent)] is not None)
+			# The restored simulation continues exactly as the original one
+			self.assertEquals(ribs[0], ribs[1])
+			self.assertEquals(updates[0], updates[1])
+			
+	def testScenarioFanOut(self):
+		
+		if active_tests['testScenarioFanOut']:
+			
+			print "Running testScenarioFanOut ..."
+			
+			parent = '1.0.0.0/22'
+			child = '1.0.0.0/24'
+			
+			def converge():
+				bgp_sim.init()
+				bgp_sim.DRAGON_FILTERING_MODE = bgp_sim.DRAGON_ROUTE_CONSISTENCY
+				bgp_sim.readConfigFile(config_dir + "dragon_fig2.cfg")
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['7.1', parent], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(2.0), ['9.1', child], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim.run()
+			
+			converge()
+			converged = rib_snapshot([parent, child])
+			scenarios = bgp_sim.linkFailureScenarios()
+			results = bgp_sim.runScenarios(scenarios, 3)
+			
+			self.assertEquals(len(scenarios), 12)
+			# The children do not modify the converged state
+			self.assertEquals(rib_snapshot([parent, child]), converged)
+			
+			for i in range(len(scenarios)):
+				converge()
+				self.assertEquals(results[i], bgp_sim.scenarioWorker(scenarios[i]))
+			# The failure of the link 7.1-9.1 changes the best paths of the child
+			self.assertTrue(child in results[scenarios.index([(1.0, ('9.1', '7.1'), bgp_sim.EVENT_LINK_DOWN)])]['changed_prefixes'])
+			
+	def testLinkFailureImpact(self):
+		
+		if active_tests['testLinkFailureImpact']:
+			
+			print "Running testLinkFailureImpact ..."
+			
+			parent = '1.0.0.0/22'
+			child = '1.0.0.0/24'
+			
+			bgp_sim.init()
+			bgp_sim.DRAGON_FILTERING_MODE = bgp_sim.DRAGON_ROUTE_CONSISTENCY
+			bgp_sim.readConfigFile(config_dir + "dragon_fig2.cfg")
+			# 9.1 does not announce anything to 6.1
+			bgp_sim.loadConfig("route-map no-announce deny")
+			bgp_sim._router_list['9.1'].peers['6.1'].route_map_out.append('no-announce')
+			bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['9.1', parent], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+			bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['9.1', child], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+			bgp_sim.run()
+			
+			impact = bgp_sim.linkFailureImpact()
+			records = bgp_sim.runLinkFailures(3)
+			scenarios = bgp_sim.linkFailureScenarios()
+			results = bgp_sim.runScenarios(scenarios, 3)
+			
+			self.assertEquals(impact[('9.1', '6.1')], set())
+			self.assertEquals(impact[('9.1', '7.1')], set([parent, child]))
+			for (scenario, result) in zip(scenarios, results):
+				link = scenario[0][1]
+				self.assertTrue(set(result['changed_prefixes']) <= impact[link])
+				# Skipped failures have the same record as simulated ones
+				del records[link]['impact']
+				self.assertEquals(records[link], result)
+			
+	def testQuiescence(self):
+		
+		if active_tests['testQuiescence']:
+			
+			print "Running testQuiescence ..."
+			
+			parent = '1.0.0.0/22'
+			child = '1.0.0.0/24'
+			
+			ribs = []
+			updates = []
+			for quiescence in [False, True]:
+				bgp_sim.QUIESCENCE_DETECTION = quiescence
+				bgp_sim.init()
+				bgp_sim.DRAGON_FILTERING_MODE = bgp_sim.DRAGON_ROUTE_CONSISTENCY
+				bgp_sim.readConfigFile(config_dir + "dragon_fig2.cfg")
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['7.1', parent], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['9.1', child], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(100.0), ['7.1', '4.1'], bgp_sim.EVENT_LINK_DOWN))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(10000.0), (), bgp_sim.EVENT_TERMINATE))
+				bgp_sim.run()
+				ribs.append(rib_snapshot([parent, child]))
+				updates.append(dict([(rid, dict(rt.num_updates)) for (rid, rt) in bgp_sim._router_list.items()]))
+			bgp_sim.QUIESCENCE_DETECTION = False
+			
+			# The run stops early, with the same outcome
+			self.assertTrue(bgp_sim._systime < bgp_sim.toSystemTime(10000.0))
+			self.assertEquals(ribs[0], ribs[1])
+			self.assertEquals(updates[0], updates[1])
+			
+			# One convergence time per injected event
+			log = bgp_sim._convergence_log
+			self.assertEquals([entry[0] for entry in log], [bgp_sim.EVENT_ANNOUNCE_PREFIX, bgp_sim.EVENT_ANNOUNCE_PREFIX, bgp_sim.EVENT_LINK_DOWN])
+			for (event_type, param, injected, converged) in log:
+				self.assertTrue(injected <= converged < bgp_sim.toSystemTime(10000.0))
+			
+	def testPerfCounters(self):
+		
+		if active_tests['testPerfCounters']:
+			
+			print "Running testPerfCounters ..."
+			
+			parent = '1.0.0.0/22'
+			child = '1.0.0.0/24'
+			(fd, report) = tempfile.mkstemp()
+			os.close(fd)
+			
+			bgp_sim.init()
+			bgp_sim.DRAGON_FILTERING_MODE = bgp_sim.DRAGON_ROUTE_CONSISTENCY
+			bgp_sim.readConfigFile(config_dir + "dragon_fig2.cfg")
+			bgp_sim.loadConfig("config perf-report " + report)
+			bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['7.1', parent], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+			bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['9.1', child], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+			bgp_sim.run()
+			bgp_sim.PERF_REPORT = None
+			
+			perf = json.load(open(report))
+			os.remove(report)
+			
+			events = perf['events']
+			self.assertEquals(events['ANNOUNCE_PREFIX']['count'], 2)
+			self.assertEquals(events['ANNOUNCE_PREFIX']['peak_queue_length'], 2)
+			self.assertTrue(events['RECEIVE']['count'] > 0)
+			# Every EVENT_UPDATE runs the decision process, as do announcements and aggregates
+			self.assertTrue(events['UPDATE']['count'] <= sum([router['decision_runs'] for router in perf['routers'].values()]))
+			self.assertTrue(perf['routers']['4.1']['aggregates_computations'] > 0)
+			for counters in events.values():
+				self.assertTrue(counters['time'] >= 0)
+			
+			# The workers of a parallel run send back their event counters
+			bgp_sim.init()
+			bgp_sim.DRAGON_FILTERING_MODE = bgp_sim.DRAGON_ROUTE_CONSISTENCY
+			bgp_sim.readConfigFile(config_dir + "dragon_fig2.cfg")
+			bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['7.1', parent], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+			bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['9.1', child], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+			bgp_sim.runParallel(2)
+			
+			parallel_events = bgp_sim.perfReport()['events']
+			for name in ['ANNOUNCE_PREFIX', 'RECEIVE', 'UPDATE']:
+				self.assertEquals(parallel_events[name]['count'], events[name]['count'])
+				self.assertTrue(parallel_events[name]['peak_queue_length'] > 0)
+			
+	def testEventTrace(self):
+		
+		if active_tests['testEventTrace']:
+			
+			print "Running testEventTrace ..."
+			
+			parent = '1.0.0.0/22'
+			child = '1.0.0.0/24'
+			other = '2.0.0.0/24'
+			(fd, trace) = tempfile.mkstemp()
+			os.close(fd)
+			
+			def configure():
+				bgp_sim.init()
+				bgp_sim.DRAGON_FILTERING_MODE = bgp_sim.DRAGON_ROUTE_CONSISTENCY
+				bgp_sim.readConfigFile(config_dir + "dragon_fig2.cfg")
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['7.1', parent], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['9.1', child], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['5.1', other], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(100.0), ['7.1', '4.1'], bgp_sim.EVENT_LINK_DOWN))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(200.0), ['7.1', '4.1'], bgp_sim.EVENT_LINK_UP))
+			
+			configure()
+			bgp_sim.startTrace(trace)
+			bgp_sim.run()
+			bgp_sim.stopTrace()
+			recorded = rib_snapshot([parent, child, other])
+			updates = dict(bgp_sim._router_list['4.1'].num_updates)
+			
+			# Whole run
+			configure()
+			bgp_sim.replayTrace(trace)
+			self.assertEquals(rib_snapshot([parent, child, other]), recorded)
+			
+			# One router, driven by the recorded UPDATEs of its neighbors
+			configure()
+			bgp_sim.replayTrace(trace, routers=['4.1'])
+			rib = rib_snapshot([parent, child, other])
+			for pfx in [parent, child, other]:
+				self.assertEquals(rib[('4.1', pfx)], recorded[('4.1', pfx)])
+			self.assertEquals(rib[('3.1', parent)], None)
+			self.assertEquals(dict(bgp_sim._router_list['4.1'].num_updates), updates)
+			
+			# One prefix family
+			configure()
+			bgp_sim.replayTrace(trace, prefixes=[parent, child])
+			rib = rib_snapshot([parent, child, other])
+			os.remove(trace)
+			for router_id in bgp_sim._router_list:
+				for pfx in [parent, child]:
+					self.assertEquals(rib[(router_id, pfx)], recorded[(router_id, pfx)])
+				self.assertEquals(rib[(router_id, other)], None)
+			
+	def testIncrementalSelection(self):
+		
+		if active_tests['testIncrementalSelection']:
+			
+			print "Running testIncrementalSelection ..."
+			
+			parent = '1.0.0.0/22'
+			child = '1.0.0.0/24'
+			
+			bgp_sim.init()
+			bgp_sim.DRAGON_FILTERING_MODE = bgp_sim.DRAGON_ROUTE_CONSISTENCY
+			bgp_sim.readConfigFile(config_dir + "dragon_fig2.cfg")
+			bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['7.1', parent], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+			bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['9.1', child], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+			bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(100.0), ['7.1', '4.1'], bgp_sim.EVENT_LINK_DOWN))
+			bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(100.0), ['3.1', '1.1'], bgp_sim.EVENT_LINK_DOWN))
+			bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(200.0), ['7.1', '4.1'], bgp_sim.EVENT_LINK_UP))
+			bgp_sim.run()
+			
+			# Same best path and forwarding neighbors as sorting all the received paths
+			for rt in bgp_sim._router_list.values():
+				received = set([prefix for peer in rt.peers.values() for prefix in peer.rib_in])
+				self.assertEquals(set(rt.adj_rib_in.selections.keys()), received)
+				for prefix in received:
+					# Both indexes of the Adj-RIB-In hold the same paths
+					self.assertEquals(rt.adj_rib_in.paths(prefix), dict([(pid, peer.rib_in[prefix]) for (pid, peer) in rt.peers.items() if prefix in peer.rib_in]))
+					inpaths = [path for peer in rt.peers.values() for path in peer.rib_in.get(prefix, [])]
+					inpaths.sort(rt.comparePath)
+					route_type = inpaths[0].route_type
+					selection = rt.adj_rib_in.selections[prefix]
+					self.assertTrue(selection.getBest() is inpaths[0])
+					self.assertEquals(selection.neighbors(route_type), set([path.src_pid for path in inpaths if path.route_type == route_type]))
+			
+	def testRankingKeys(self):
+		
+		if active_tests['testRankingKeys']:
+			
+			print "Running testRankingKeys ..."
+			
+			rand = random.Random(7)
+			bgp_sim.init()
+			router = bgp_sim.CRouter(1, '1.1')
+			
+			def random_path(pid):
+				path = bgp_sim.CPath()
+				path.src_pid = pid
+				path.nexthop = rand.choice(['2.1', '3.1', '4.1'])
+				path.local_pref = rand.choice([50, 100])
+				path.aspath = bgp_sim.asPath([rand.choice([2, 3, 4]) for i in range(rand.randint(0, 2))])
+				path.med = rand.choice([0, 0, 5])
+				path.igp_cost = rand.choice([0, 10])
+				path.community = (rand.randint(1, 3),)
+				return bgp_sim.internPath(path)
+			
+			for always_compare_med in [False, True]:
+				bgp_sim.bgp_always_compare_med = always_compare_med
+				# Interned paths keep the ranking key computed with the previous setting
+				bgp_sim.init()
+				for i in range(300):
+					# Sorting on ranking keys gives the order of compareTo
+					paths = [random_path(str(j)) for j in range(rand.randint(1, 6))]
+					expected = paths[:]
+					expected.sort(router.comparePath)
+					router.sortPaths(paths)
+					self.assertEquals([id(path) for path in paths], [id(path) for path in expected])
+				
+				# The incremental selection follows the received paths
+				selection = bgp_sim.CPathSelection()
+				ranks = dict([(str(j), j) for j in range(8)])
+				received = {}
+				for i in range(500):
+					pid = rand.choice(ranks.keys())
+					received[pid] = [random_path(pid) for j in range(rand.randint(0, 2))]
+					selection.set(pid, ranks[pid], received[pid])
+					expected = [path for pid in sorted(ranks, key=ranks.get) for path in received.get(pid, [])]
+					if expected:
+						expected.sort(router.comparePath)
+						paths = selection.selectedPaths()
+						router.sortPaths(paths)
+						self.assertTrue(paths[0] is expected[0])
+			bgp_sim.bgp_always_compare_med = False
+			
+	def testPathInterning(self):
+		
+		if active_tests['testPathInterning']:
+			
+			print "Running testPathInterning ..."
+			
+			bgp_sim.init()
+			bgp_sim.DRAGON_FILTERING_MODE = bgp_sim.DRAGON_ROUTE_CONSISTENCY
+			bgp_sim.readConfigFile(config_dir + "dragon_fig2.cfg")
+			bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['7.1', '1.0.0.0/22'], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+			bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['9.1', '1.0.0.0/24'], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+			bgp_sim.run()
+			
+			# Equal attribute sets are shared, with their route type
+			shared = {}
+			for router in bgp_sim._router_list.values():
+				paths = router.origin_rib.values()
+				for peer in router.peers.values():
+					for prefix_paths in peer.rib_in.values():
+						paths.extend(prefix_paths)
+				for path in paths:
+					self.assertEquals(path.route_type, path.community[0])
+					key = (path.index, path.src_pid, path.weight, path.local_pref, path.med, path.nexthop,\
+						path.igp_cost, path.community, path.aspath, path.alternative)
+					self.assertTrue(shared.setdefault(key, path) is path)
+			self.assertTrue(len(shared) > 0)
+			
+			# Route map actions build new attribute sets
+			route_map = bgp_sim.CRouteMap("test", "permit", 10)
+			route_map.action = [["community", "3:2", "additive"], ["as-path", "prepend", "5", "5"]]
+			path = bgp_sim.CPath()
+			path.community = (bgp_sim.ATTRIBUTE_CUST,)
+			path.aspath = bgp_sim.asPath((7,))
+			path = bgp_sim.internPath(route_map.performAction(path))
+			self.assertEquals(path.community, (1, 2, 3))
+			self.assertEquals(path.route_type, bgp_sim.ATTRIBUTE_CUST)
+			self.assertEquals(path.aspath, (5, 5, 7))
+			route_map.match = [["community-list", "2:3", "any"]]
+			self.assertTrue(route_map.isMatch('1.0.0.0/24', path))
+			route_map.match = [["community-list", "1:3", "exact"]]
+			self.assertFalse(route_map.isMatch('1.0.0.0/24', path))
+			
+	def testASPathTrie(self):
+		
+		if active_tests['testASPathTrie']:
+			
+			print "Running testASPathTrie ..."
+			
+			aspath = bgp_sim.asPath((3, 65, 7))
+			self.assertTrue(aspath is bgp_sim.asPath((65, 7)).prepend(3))
+			self.assertTrue(aspath.tail.tail is bgp_sim.asPath([7]))
+			self.assertEquals(len(aspath), 3)
+			self.assertEquals(aspath, (3, 65, 7))
+			self.assertNotEquals(aspath, bgp_sim.asPath((3, 7)))
+			self.assertEquals((aspath[0], aspath[-1]), (3, 7))
+			self.assertEquals(str(aspath), str((3, 65, 7)))
+			self.assertEquals(aspath.pathString(), "3_65_7")
+			# AS 1 has the same bloom filter bit as AS 65
+			self.assertTrue(65 in aspath)
+			self.assertFalse(1 in aspath)
+			self.assertFalse(4 in aspath)
+			self.assertEquals(len(bgp_sim.asPath(())), 0)
+			
+			# Unpickled paths are the nodes of the trie
+			self.assertTrue(cPickle.loads(cPickle.dumps(aspath, cPickle.HIGHEST_PROTOCOL)) is aspath)
+			
+			# Unused paths are freed, with the part of their tail no other path uses
+			tail = bgp_sim.asPath((65, 7))
+			bgp_sim.asPath((9, 8, 65, 7))
+			self.assertFalse(8 in tail.children)
+			self.assertTrue(3 in tail.children)
+			del aspath
+			self.assertEquals(len(tail.children), 0)
+			
+	def testUpdateGroups(self):
+		
+		if active_tests['testUpdateGroups']:
+			
+			print "Running testUpdateGroups ..."
+			
+			parent = '1.0.0.0/22'
+			child = '1.0.0.0/24'
+			
+			ribs = []
+			for split in [False, True]:
+				bgp_sim.init()
+				bgp_sim.DRAGON_FILTERING_MODE = bgp_sim.DRAGON_ROUTE_CONSISTENCY
+				bgp_sim.readConfigFile(config_dir + "dragon_fig2.cfg")
+				if split:
+					# Same policy as the other customers of 1.1, in another group
+					bgp_sim.loadConfig("route-map no-filter permit")
+					bgp_sim._router_list['1.1'].peers['6.1'].route_map_out.append('no-filter')
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['7.1', parent], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['9.1', child], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim.run()
+				
+				ribs.append(rib_snapshot([parent, child]))
+				
+				router = bgp_sim._router_list['1.1']
+				customers = [router.peers[pid] for pid in ['3.1', '5.1', '6.1']]
+				self.assertTrue(router.peers['2.1'].update_group is not customers[0].update_group)
+				self.assertTrue(customers[0].update_group is customers[1].update_group)
+				self.assertEquals(customers[1].update_group is customers[2].update_group, not split)
+				# The path from 3.1 is exported once to 5.1 and 6.1
+				self.assertEquals(router.loc_rib.search_exact(parent).data['best_path'].src_pid, '3.1')
+				self.assertEquals(customers[1].rib_out[parent] is customers[2].rib_out[parent], not split)
+				self.assertEquals(customers[1].rib_out[parent], customers[2].rib_out[parent])
+				
+				num_exports = sum([rt.num_exports for rt in bgp_sim._router_list.values()])
+				num_updates = sum([sum(rt.num_updates.values()) for rt in bgp_sim._router_list.values()])
+				self.assertTrue(0 < num_exports < num_updates)
+			
+			# Update groups do not change the converged state
+			self.assertEquals(ribs[0], ribs[1])
+			
+			# Route maps of the same priority are applied in config order
+			bgp_sim.init()
+			bgp_sim.readConfigFile(config_dir + "dragon_fig2.cfg")
+			bgp_sim.loadConfig("route-map no-filter permit")
+			router = bgp_sim._router_list['1.1']
+			router.peers['5.1'].route_map_out.append('no-filter')
+			router.peers['6.1'].route_map_out.insert(0, 'no-filter')
+			router.buildUpdateGroups()
+			self.assertTrue(router.peers['5.1'].update_group is not router.peers['6.1'].update_group)
+			self.assertEquals(router.peers['6.1'].getRouteMapOut(), ['no-filter', 'community-strip'])
+			
+	def testOutQueue(self):
+		
+		if active_tests['testOutQueue']:
+			
+			print "Running testOutQueue ..."
+			
+			bgp_sim.init()
+			bgp_sim.DRAGON_FILTERING_MODE = bgp_sim.DRAGON_ROUTE_CONSISTENCY
+			bgp_sim.readConfigFile(config_dir + "dragon_fig2.cfg")
+			bgp_sim.run()
+			
+			# Prefixes are sent in the order of their last enqueue
+			router = bgp_sim._router_list['1.1']
+			peer = router.peers['3.1']
+			for prefix in ['1.0.0.0/24', '2.0.0.0/24', '3.0.0.0/24', '1.0.0.0/24', '4.0.0.0/24']:
+				peer.enqueue(prefix)
+			peer.dequeue('3.0.0.0/24')
+			peer.dequeue('5.0.0.0/24')
+			self.assertEquals(list(peer.out_queue), ['2.0.0.0/24', '1.0.0.0/24', '4.0.0.0/24'])
+			
+			sent = []
+			router.sendtopeer = lambda pid, prefix: sent.append(prefix)
+			router.sendto('3.1', '1.0.0.0/24')
+			self.assertEquals(list(peer.out_queue), ['2.0.0.0/24', '4.0.0.0/24'])
+			router.sendto('3.1', None)
+			self.assertEquals(sent, ['1.0.0.0/24', '2.0.0.0/24', '4.0.0.0/24'])
+			self.assertEquals(len(peer.out_queue), 0)
+			
+	def testMRAITimerWheel(self):
+		
+		if active_tests['testMRAITimerWheel']:
+			
+			print "Running testMRAITimerWheel ..."
+			
+			# Timers are expired by deadline, across levels, after cascading
+			wheel = bgp_sim.CTimerWheel()
+			wheel.schedule('a', 5e7)
+			wheel.schedule('b', 3000.0)
+			wheel.schedule('c', 3e5)
+			wheel.schedule('d', 3e5)
+			wheel.schedule('e', 1e9)
+			wheel.schedule('b', 4e5)
+			wheel.cancel('d')
+			self.assertEquals(wheel.nextDeadline(), 3e5)
+			self.assertEquals(wheel.expire(1e5), [])
+			self.assertEquals(wheel.expire(6e7), ['c', 'b', 'a'])
+			self.assertEquals(wheel.keys(), ['e'])
+			self.assertEquals(wheel.nextDeadline(), 1e9)
+			
+			parent = '1.0.0.0/22'
+			child = '1.0.0.0/24'
+			
+			ribs = []
+			updates = []
+			peaks = []
+			for (prefix_based, timer_wheel) in [(False, False), (True, False), (True, True)]:
+				bgp_sim.init()
+				bgp_sim.MRAI_TIMER_WHEEL = timer_wheel
+				bgp_sim.DRAGON_FILTERING_MODE = bgp_sim.DRAGON_ROUTE_CONSISTENCY
+				bgp_sim.readConfigFile(config_dir + "dragon_fig2.cfg")
+				for router in bgp_sim._router_list.values():
+					for peer in router.peers.values():
+						peer.mrai_base = 30.0
+					if prefix_based:
+						router.mrai_setting = bgp_sim.MRAI_PREFIX_BASED
+				
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(1.0), ['7.1', parent], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(2.0), ['9.1', child], bgp_sim.EVENT_ANNOUNCE_PREFIX))
+				bgp_sim._event_Scheduler.add(bgp_sim.CEvent(bgp_sim.toSystemTime(3.0), ['7.1', '4.1'], bgp_sim.EVENT_LINK_DOWN))
+				bgp_sim.run()
+				bgp_sim.MRAI_TIMER_WHEEL = False
+				
+				ribs.append(rib_snapshot([parent, child]))
+				updates.append(dict([(rid, dict(rt.num_updates)) for (rid, rt) in bgp_sim._router_list.items()]))
+				peaks.append(bgp_sim._perf_peak[bgp_sim.EVENT_MRAI_EXPIRE_SENDTO] + bgp_sim._perf_peak[bgp_sim.EVENT_MRAI_WHEEL])
+			
+			self.assertTrue(ribs[1][('7.1', parent)] is not None)
+			# Per-prefix timers converge to the same routes
+			self.assertEquals(ribs[0], ribs[1])
+			self.assertEquals(ribs[1], ribs[2])
+			self.assertEquals(updates[1], updates[2])
+			# The wheel schedules one event per router instead of one per timer
+			self.assertTrue(0 < peaks[2] < peaks[1])
+			
+	def testRouteMapCompilation(self):
+		
+		if active_tests['testRouteMapCompilation']:
+			
+			print "Running testRouteMapCompilation ..."
+			
+			bgp_sim.init()
+			bgp_sim.loadConfig('''
+route-map tag permit 10
+ match as-path ^7
+ match metric 5
+ set community 4:5 additive
+ set local-preference 200
+route-map only permit 20
+ match ip address 1.0.0.0/24
+route-map drop deny 30
+ match community-list 4:9 any
+''')
+			tag = bgp_sim._route_map_list['tag']
+			only = bgp_sim._route_map_list['only']
+			drop = bgp_sim._route_map_list['drop']
+			# Maps are compiled at config load: filters reject, maps with actions apply
+			self.assertTrue(tag.rejects is None and tag.apply is not None)
+			self.assertTrue(only.apply is None and drop.apply is None)
+			
+			path = bgp_sim.CPath()
+			path.community = (bgp_sim.ATTRIBUTE_CUST,)
+			path.aspath = bgp_sim.asPath((7, 3))
+			path.med = 5
+			path = bgp_sim.internPath(path)
+			self.assertFalse(only.rejects('1.0.0.0/24', path))
+			self.assertTrue(only.rejects('2.0.0.0/24', path))
+			self.assertFalse(drop.rejects('1.0.0.0/24', path))
+			
+			newpath = bgp_sim.CPath()
+			newpath.copy(path)
+			newpath = bgp_sim.internPath(tag.apply('1.0.0.0/24', newpath))
+			self.assertEquals(newpath.community, (1, 4, 5))
+			self.assertEquals(newpath.local_pref, 200)
+			self.assertTrue(drop.rejects('1.0.0.0/24', newpath))
+			
+			# A condition which does not hold leaves the path unchanged
+			newpath = bgp_sim.CPath()
+			newpath.copy(path)
+			newpath.med = 6
+			self.assertEquals(tag.apply('1.0.0.0/24', newpath).local_pref, path.local_pref)
+			
+			# Route maps changed after the config is loaded
+			only.match = [["ip", "address", "2.0.0.0/24"]]
+			self.assertTrue(only.rejects('1.0.0.0/24', path))
+			self.assertFalse(only.isMatch('1.0.0.0/24', path))
+			only.match.append(["metric", "6"])
+			self.assertFalse(only.isMatch('2.0.0.0/24', path))
+			
+			# Snapshots compile the route maps again
+			tag = cPickle.loads(cPickle.dumps(tag, cPickle.HIGHEST_PROTOCOL))
+			newpath.med = 5
+			self.assertEquals(tag.apply('1.0.0.0/24', newpath).local_pref, 200)
 			
 if __name__ == '__main__':
 	unittest.main()
\ No newline at end of file